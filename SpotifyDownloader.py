@@ -9,13 +9,27 @@ import json
 
 from PyQt6.QtWidgets import (
     QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit,
-    QLabel, QFileDialog, QListWidget, QMessageBox, QTextEdit, QProgressBar
+    QLabel, QFileDialog, QListWidget, QMessageBox, QProgressBar, QCheckBox,
+    QPlainTextEdit, QTableView, QHeaderView, QSplitter, QAbstractItemView
 )
-from PyQt6.QtCore import Qt, QThread, pyqtSignal, QSettings, QSize
+from PyQt6.QtCore import Qt, QThread, pyqtSignal, QSettings, QSize, QTimer
 from PyQt6.QtGui import QIcon, QTextCursor
 
 
-from spotify_scraper import SpotifyScraperThread
+from scraper_thread import SpotifyScraperThread
+from track_table import TrackTableModel
+from cover_cache import CoverCache
+from metadata_cache import MetadataCache, uniform_ttls
+from app_dirs import user_cache_dir
+from rate_limiter import BandwidthLimiter, parse_rate, parse_schedule
+from token_manager import TokenPool
+from token_grabber import default_provider
+
+
+# lines kept in the log, older ones are dropped
+MAX_LOG_LINES = 5000
+# how often buffered updates from the scraper thread are applied, in ms
+UPDATE_INTERVAL = 200
 
 
 class SpotifyDownGUI(QWidget):
@@ -31,24 +45,69 @@ class SpotifyDownGUI(QWidget):
         self.last_output_path = None
         
         self.log_output = None
+        self.track_table = None
+        self.track_model = None
+        self.update_timer = None
         
         self.token = ''
+        self.max_workers = 4
+        self.max_per_host = 0
+        self.token_ttl = 300
+        self.use_metadata_cache = True
+        self.metadata_cache_ttl = 0
+        self.metadata_cache_input = None
+        self.use_library = True
+        self.bandwidth = BandwidthLimiter()
+        self.token_pool_size = 0
+        self.token_leases = 0
+        self.token_pool = None
+        # problems with the settings, shown in the log once it is built
+        self.config_errors = []
         self.scraper_thread = None
+        self.cover_cache = CoverCache(cache_dir=user_cache_dir("covers"))
+        self.metadata_cache = None
         
         self.load_config()
+        # opened even when unused, the checkbox can turn it on for the next run
+        self.metadata_cache = MetadataCache(user_cache_dir() / "metadata.sqlite3",
+            ttls=uniform_ttls(self.metadata_cache_ttl * 60 * 60) if self.metadata_cache_ttl else None)
+        if self.token_pool_size:
+            self.token_pool = TokenPool(self.fetch_pool_token, self.token_pool_size, ttl=self.token_ttl,
+                max_leases=self.token_leases, path=user_cache_dir() / "token_pool.json")
     
         self.initUI()
+        for error in self.config_errors:
+            self.progress_updated(error)
       
       
     def load_config(self):
         self.token = self.settings.value('token', '')
         self.last_output_path = self.settings.value('output_path', os.path.expanduser("~/Music"))
         self.last_spotify_url = self.settings.value('spotify_url', "")
+        self.max_workers = self.settings.value('max_workers', 4, type=int)
+        self.max_per_host = self.settings.value('max_per_host', 0, type=int)
+        self.token_ttl = self.settings.value('token_ttl', 300, type=int)
+        self.use_metadata_cache = self.settings.value('use_metadata_cache', True, type=bool)
+        # hours cached api responses are trusted, 0 for the defaults in metadata_cache.py
+        self.metadata_cache_ttl = self.settings.value('metadata_cache_ttl_hours', 0, type=float)
+        self.use_library = self.settings.value('use_library', True, type=bool)
+        # tokens resolving links side by side, 0 for the single token above
+        self.token_pool_size = self.settings.value('token_pool_size', 0, type=int)
+        self.token_leases = self.settings.value('token_leases', 0, type=int)
+        # e.g. "2M", and "09:00-18:00=500K,18:00-09:00=0"
+        try:
+            self.bandwidth = BandwidthLimiter(parse_rate(self.settings.value('bandwidth_limit', '0')),
+                parse_rate(self.settings.value('host_bandwidth_limit', '0')),
+                parse_schedule(self.settings.value('bandwidth_schedule', '')))
+        except ValueError as e:
+            # the log is not there yet
+            self.config_errors.append(f"Ignoring bandwidth settings, downloads are not capped: {str(e)}")
          
     def save_config(self):
         self.settings.setValue('token', self.token)
         self.settings.setValue('output_path', self.output_path_input.text().strip())
         self.settings.setValue('spotify_url', self.spotify_url_input.text().strip())
+        self.settings.setValue('use_metadata_cache', self.metadata_cache_input.isChecked())
         self.settings.sync()
 
 
@@ -75,6 +134,12 @@ class SpotifyDownGUI(QWidget):
         self.spotify_url_input.returnPressed.connect(self.scrape)
         spotify_layout.addWidget(self.spotify_url_input)
         
+        # cached track lists are checked against the api anyway, this skips the cache altogether
+        self.metadata_cache_input = QCheckBox('Use cache')
+        self.metadata_cache_input.setToolTip("Reuse album and track details fetched before. Playlists and albums are still checked for changes.")
+        self.metadata_cache_input.setChecked(self.use_metadata_cache)
+        spotify_layout.addWidget(self.metadata_cache_input)
+        
         self.main_layout.addLayout(spotify_layout)
     
     def setup_output_section(self):
@@ -95,9 +160,32 @@ class SpotifyDownGUI(QWidget):
         self.main_layout.addLayout(output_layout)
              
     def setup_progress_section(self):
-        self.log_output = QTextEdit()
+        splitter = QSplitter(Qt.Orientation.Vertical)
+        
+        # the view only paints visible rows, fixed row heights keep it from measuring every row
+        self.track_model = TrackTableModel(self)
+        self.track_table = QTableView()
+        self.track_table.setModel(self.track_model)
+        self.track_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.track_table.verticalHeader().setVisible(False)
+        self.track_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.track_table.verticalHeader().setDefaultSectionSize(20)
+        header = self.track_table.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
+        header.setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
+        header.resizeSection(0, 50)
+        header.resizeSection(2, 160)
+        splitter.addWidget(self.track_table)
+        
+        self.log_output = QPlainTextEdit()
         self.log_output.setReadOnly(True)
-        self.main_layout.addWidget(self.log_output)
+        self.log_output.setMaximumBlockCount(MAX_LOG_LINES)
+        splitter.addWidget(self.log_output)
+        self.main_layout.addWidget(splitter)
+        
+        self.update_timer = QTimer(self)
+        self.update_timer.setInterval(UPDATE_INTERVAL)
+        self.update_timer.timeout.connect(self.apply_updates)
         
         self.progress_bar = QProgressBar()
         self.main_layout.addWidget(self.progress_bar)
@@ -111,6 +199,7 @@ class SpotifyDownGUI(QWidget):
     def clear(self):
         self.progress_percent_updated(100, 0, 0, 0)
         self.log_output.clear()
+        self.track_model.clear()
     
     def scrape(self):
         if self.scraper_thread is not None:
@@ -118,24 +207,39 @@ class SpotifyDownGUI(QWidget):
         try:
             self.clear()
             self.save_config()
-            self.scraper_thread = SpotifyScraperThread(self.spotify_url_input.text(), self.token, self.output_path_input.text())    
+            self.scraper_thread = SpotifyScraperThread(self.spotify_url_input.text(), self.token, self.output_path_input.text(),
+                max_workers=self.max_workers, max_per_host=self.max_per_host or None, cover_cache=self.cover_cache,
+                token_ttl=self.token_ttl, metadata_cache=self.metadata_cache if self.metadata_cache_input.isChecked() else None, use_library=self.use_library,
+                bandwidth=self.bandwidth, token_pool=self.token_pool)
             self.scraper_thread.finished.connect(self.thread_finished)
             self.scraper_thread.token_updated.connect(self.token_updated)
-            self.scraper_thread.progress_updated.connect(self.progress_updated)
-            self.scraper_thread.counts.connect(self.progress_percent_updated)
             self.scraper_thread.start()
+            self.update_timer.start()
         except ValueError as e:
             update_progress(str(e))
             update_progress(traceback.format_exc())
     
     
     def thread_finished(self):
+        self.update_timer.stop()
+        self.apply_updates()
         self.scraper_thread.deleteLater()
         self.scraper_thread = None
         self.progress_updated("Scraping Completed.")
 
+    def apply_updates(self):
+        if self.scraper_thread is None:
+            return
+        messages, tracks, counts = self.scraper_thread.take_updates()
+        if tracks:
+            self.track_model.update_tracks(tracks)
+        if messages:
+            self.progress_updated("\n".join(messages))
+        if counts is not None:
+            self.progress_percent_updated(*counts)
+    
     def progress_updated(self, message):
-        self.log_output.append(message)
+        self.log_output.appendPlainText(message)
         self.log_output.moveCursor(QTextCursor.MoveOperation.End)
             
     def progress_percent_updated(self, track_count, downloaded, skipped, failed):
@@ -144,6 +248,13 @@ class SpotifyDownGUI(QWidget):
     def token_updated(self, token):
         self.token = token
         self.save_config()
+    
+    def fetch_pool_token(self):
+        # runs on the pool's thread, tracks waiting on a failed fetch are retried
+        try:
+            return default_provider().get_token()
+        except Exception:
+            return None
           
 
 # Main
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from rate_limiter import THROTTLE_STATUSES
+
+
+def is_failure(resp):
+    return resp.status_code >= 500 or resp.status_code in THROTTLE_STATUSES
+
+
+class EndpointStats:
+    # recent latencies and failures of one api base url
+
+    def __init__(self, url, window=200):
+        self.url = url.rstrip("/")
+        self.latencies = deque(maxlen=window)
+        self.failures = deque(maxlen=window)
+
+    def record(self, seconds, failed):
+        self.failures.append(failed)
+        if not failed:
+            self.latencies.append(seconds)
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(percent / 100 * len(latencies)))]
+
+    def failure_rate(self):
+        return sum(self.failures) / len(self.failures) if self.failures else 0.0
+
+
+class ApiEndpoints:
+    # one or more base urls of the downloader api. Requests go to the endpoint
+    # answering best lately. If it has not answered once the hedge deadline passed,
+    # the same request goes to the next endpoint too and the first good answer wins.
+    # The deadline is a percentile of its recent latencies, but at most a few times
+    # their median: when slow answers are about as common as 100 - percentile, the
+    # percentile itself lands in the slow tail and cuts nothing. Hedges are capped at
+    # max_hedge_ratio of all requests, so a slow patch does not double the load.
+    # A request that fails everywhere it was sent is tried on the remaining endpoints.
+
+    def __init__(self, urls, hedge_percentile=95, hedge_median_multiple=3, default_hedge_delay=0.25, min_hedge_delay=0.02,
+                 max_hedge_delay=10.0, max_hedge_ratio=0.1, min_samples=10, max_workers=32):
+        self.endpoints = [EndpointStats(url) for url in urls]
+        self.hedge_percentile = hedge_percentile
+        self.hedge_median_multiple = hedge_median_multiple
+        # used until an endpoint has min_samples latencies
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_delay = max_hedge_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self.requests = 0
+        self.hedges = 0
+        self.executor = None
+        self.lock = threading.Lock()
+
+    @property
+    def urls(self):
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def ranked(self):
+        # mostly failing endpoints last, then by median latency. Endpoints not tried yet come first.
+        with self.lock:
+            return sorted(self.endpoints, key=lambda endpoint: (endpoint.failure_rate() > 0.5, endpoint.percentile(50) or 0.0))
+
+    def hedge_delay(self, endpoint):
+        with self.lock:
+            if len(endpoint.latencies) < self.min_samples:
+                return self.default_hedge_delay
+            delay = min(endpoint.percentile(self.hedge_percentile), self.hedge_median_multiple * endpoint.percentile(50))
+        return min(self.max_hedge_delay, max(self.min_hedge_delay, delay))
+
+    def take_hedge(self):
+        with self.lock:
+            if self.hedges >= self.max_hedge_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def timed_get(self, http, endpoint, path, headers, **kwargs):
+        start = time.perf_counter()
+        try:
+            resp = http.get(endpoint.url + path, headers=headers, **kwargs)
+        except Exception:
+            with self.lock:
+                endpoint.record(time.perf_counter() - start, True)
+            raise
+        with self.lock:
+            endpoint.record(time.perf_counter() - start, is_failure(resp))
+        return resp
+
+    def get(self, http, path, headers, metrics=None, **kwargs):
+        ranked = self.ranked()
+        with self.lock:
+            self.requests += 1
+        if len(ranked) == 1:
+            return self.timed_get(http, ranked[0], path, headers, **kwargs)
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="api")
+        primary = self.executor.submit(self.timed_get, http, ranked[0], path, headers, **kwargs)
+        attempts = {primary: ranked[0]}
+        done, _ = wait([primary], timeout=self.hedge_delay(ranked[0]))
+        if not done and self.take_hedge():
+            if metrics is not None:
+                metrics.count("api_hedges")
+            attempts[self.executor.submit(self.timed_get, http, ranked[1], path, headers, **kwargs)] = ranked[1]
+
+        resp = error = None
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    resp = future.result()
+                except Exception as exc:
+                    error = exc
+                    continue
+                if not is_failure(resp):
+                    if future is not primary and metrics is not None:
+                        metrics.count("api_hedges_won")
+                    # the slower attempt finishes in the background, its answer is dropped
+                    return resp
+
+        for endpoint in ranked:
+            if endpoint in attempts.values():
+                continue
+            if metrics is not None:
+                metrics.count("api_failovers")
+            try:
+                resp = self.timed_get(http, endpoint, path, headers, **kwargs)
+            except Exception as exc:
+                error = exc
+                continue
+            if not is_failure(resp):
+                return resp
+        if resp is not None:
+            return resp
+        raise error
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
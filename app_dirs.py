@@ -0,0 +1,17 @@
+import os
+import platform
+from pathlib import Path
+
+
+def user_cache_dir(*parts):
+    # per user cache folder, following each platform's convention
+    system = platform.system()
+    if system == "Darwin":
+        base = Path.home() / "Library" / "Caches"
+    elif system == "Windows":
+        base = Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local"))
+    else:
+        base = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+    path = base.joinpath("SpotifyDownloader", *parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+# Offline benchmarks, run against mock_api so nothing leaves the machine:
+#   python benchmark.py                              all scenarios
+#   python benchmark.py playlist --latency 0.05 --forbidden-rate 0.01
+#   python benchmark.py --json results.json          save the numbers
+#   python benchmark.py --baseline results.json      fail on regressions
+#   python benchmark.py album --endpoints 2 --slow-rate 0.05   hedging against a slow tail
+#   python benchmark.py album --token-interval 0.1 --token-pool 4   several tokens resolving links
+# Each scenario runs in a fresh process, so its peak RSS is its own.
+
+import argparse
+import json
+import logging
+import math
+import sys
+import tempfile
+import threading
+import time
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+# scenario: (entity type, track count)
+SCENARIOS = {
+    "track": ("track", 1),
+    "album": ("album", 50),
+    "playlist": ("playlist", 5000),
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the downloader against a local mock api.")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--workers", type=int, default=4, help="tracks downloaded concurrently (default: 4)")
+    parser.add_argument("--max-per-host", type=int, default=0, help="max connections per host, 0 for no cap")
+    parser.add_argument("--api-rate", type=float, default=0, help="max api requests per second, 0 for no limit (default)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every mock response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of requests taking --slow-latency seconds more")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="seconds added to the slow requests (default: 1)")
+    parser.add_argument("--endpoints", type=int, default=1, help="mock api servers to spread the calls over, with hedging (default: 1)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with a 429")
+    parser.add_argument("--forbidden-rate", type=float, default=0.0, help="share of /download calls rejecting the token")
+    parser.add_argument("--token-quota", type=int, default=0, help="/download calls each token is good for, 0 for no limit")
+    parser.add_argument("--token-interval", type=float, default=0.0, help="seconds between two /download calls with the same token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds fetching a token takes, like solving the captcha")
+    parser.add_argument("--token-pool", type=int, default=0, help="resolve links with a pool of this many tokens (default: a single token)")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429 (default: 1)")
+    parser.add_argument("--audio-kb", type=int, default=256, help="size of each audio file (default: 256)")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the injected failures")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier run, exit with 1 if this run is slower, has a slower p99, uses more memory or makes more api calls")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown against the baseline (default: 0.1)")
+    parser.add_argument("--p99-tolerance", type=float, default=0.2, help="allowed growth of the p99 track latency against the baseline (default: 0.2)")
+    parser.add_argument("--rss-tolerance", type=float, default=0.1, help="allowed growth of the peak rss against the baseline (default: 0.1)")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    return args
+
+
+class BenchmarkTokenProvider:
+    # hands out a new token instantly, instead of solving the captcha in a browser
+
+    def __init__(self, latency=0.0):
+        self.browser = None
+        self.latency = latency
+        self.fetched = 0
+        self.lock = threading.Lock()
+
+    def get_token(self):
+        time.sleep(self.latency)
+        with self.lock:
+            self.fetched += 1
+            return f"benchmark-token-{self.fetched:04d}"
+
+    def prefetch(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_scenario(name, options):
+    from spotify_scraper import SpotifyScraper
+    from http_client import HttpClient, host_of
+    from rate_limiter import RateLimiter
+    from mock_api import MockApi
+    from api_endpoints import ApiEndpoints
+    from token_manager import TokenPool
+
+    logging.getLogger("eyed3").setLevel(logging.ERROR)
+    entity_type, count = SCENARIOS[name]
+    apis = [MockApi(latency=options["latency"], jitter=options["jitter"], error_rate=options["error_rate"],
+        throttle_rate=options["throttle_rate"], forbidden_rate=options["forbidden_rate"],
+        retry_after=options["retry_after"], audio_size=options["audio_kb"] * 1024, seed=options["seed"] + index,
+        slow_rate=options["slow_rate"], slow_latency=options["slow_latency"],
+        token_quota=options["token_quota"], token_interval=options["token_interval"]).start()
+        for index in range(max(1, options["endpoints"]))]
+    api_endpoints = ApiEndpoints([api.url for api in apis])
+    rates = {host_of(api.url): options["api_rate"] for api in apis} if options["api_rate"] else {}
+    http_client = HttpClient(pool_maxsize=max(10, options["workers"]), max_per_host=options["max_per_host"] or None,
+        rate_limiter=RateLimiter(rates))
+    token_provider = BenchmarkTokenProvider(options["token_latency"])
+    token_pool = TokenPool(token_provider.get_token, options["token_pool"]) if options["token_pool"] else None
+    try:
+        with tempfile.TemporaryDirectory() as output_path:
+            scraper = SpotifyScraper(f"https://open.spotify.com/{entity_type}/bench{count}", "benchmark-token-0000", output_path,
+                max_workers=options["workers"], http_client=http_client, token_provider=token_provider, api_endpoints=api_endpoints,
+                token_pool=token_pool)
+            # the same sinks as SpotifyScraperThread, without Qt
+            messages = []
+            updated_tracks = {}
+            scraper.progress_updated.connect(messages.append)
+            scraper.track_updated.connect(lambda track: updated_tracks.__setitem__(id(track), track))
+            start = time.perf_counter()
+            scraper.run()
+            seconds = time.perf_counter() - start
+    finally:
+        if token_pool is not None:
+            token_pool.close()
+        api_endpoints.close()
+        http_client.close()
+        for api in apis:
+            api.stop()
+    api_calls = sum((api.calls for api in apis), Counter())
+
+    latencies = [track.finished_at - track.started_at for track in scraper.tracks if track.finished_at is not None]
+    p50 = percentile(latencies, 50)
+    p99 = percentile(latencies, 99)
+    return {
+        "scenario": name,
+        "tracks": scraper.track_count(),
+        "downloaded": scraper.downloaded_track_count(),
+        "skipped": scraper.skipped_track_count(),
+        "failed": scraper.failed_track_count(),
+        "seconds": round(seconds, 3),
+        "tracks_per_sec": round(scraper.track_count() / seconds, 2) if seconds else None,
+        "p50_ms": round(1000 * p50, 1) if p50 is not None else None,
+        "p99_ms": round(1000 * p99, 1) if p99 is not None else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1) if resource is not None else None,
+        "tokens_fetched": token_provider.fetched,
+        "api_calls": dict(sorted(api_calls.items())),
+        "metrics": scraper.metrics.summary(),
+    }
+
+
+def print_results(results):
+    columns = ["scenario", "tracks", "failed", "seconds", "tracks_per_sec", "p50_ms", "p99_ms", "peak_rss_mb", "tokens_fetched"]
+    rows = [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(column), *(len(row[index]) for row in rows)) for index, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+    for result in results:
+        print(f"{result['scenario']} api calls: " + ", ".join(f"{endpoint} {count}" for endpoint, count in result['api_calls'].items()))
+
+
+def regressions(results, baseline, tolerance, p99_tolerance=0.2, rss_tolerance=0.1):
+    # slower than the baseline by more than tolerance, a p99 latency or peak rss grown by
+    # more than theirs, or more api calls for the same scenario
+    found = []
+    baseline = {result["scenario"]: result for result in baseline}
+    for result in results:
+        before = baseline.get(result["scenario"])
+        if before is None:
+            continue
+        if before["tracks_per_sec"] and result["tracks_per_sec"] < before["tracks_per_sec"] * (1 - tolerance):
+            found.append(f"{result['scenario']}: {result['tracks_per_sec']} tracks/sec, was {before['tracks_per_sec']}")
+        # missing in baselines written before they were measured, and peak rss without the resource module
+        for key, unit, allowed in (("p99_ms", "ms p99", p99_tolerance), ("peak_rss_mb", "MB peak rss", rss_tolerance)):
+            if before.get(key) and result.get(key) is not None and result[key] > before[key] * (1 + allowed):
+                found.append(f"{result['scenario']}: {result[key]} {unit}, was {before[key]}")
+        for endpoint, calls in result["api_calls"].items():
+            if calls > before["api_calls"].get(endpoint, 0) and not endpoint.startswith("injected"):
+                found.append(f"{result['scenario']}: {calls} {endpoint} calls, was {before['api_calls'].get(endpoint, 0)}")
+    return found
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = vars(args)
+    results = []
+    for name in args.scenarios:
+        # a fresh process per scenario, spawned so nothing is inherited from this one
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results.append(executor.submit(run_scenario, name, options).result())
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            found = regressions(results, json.load(fp), args.tolerance, args.p99_tolerance, args.rss_tolerance)
+        for regression in found:
+            print(f"regression: {regression}")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
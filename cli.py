@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+# Headless entry point, e.g. for cron:
+#   python cli.py https://open.spotify.com/playlist/{id} -o ~/Music
+# Heavy modules (requests, eyed3, zendriver) are only imported once needed.
+
+import time
+START_TIME = time.perf_counter()
+
+import argparse
+import logging
+import os
+import sys
+
+from app_dirs import user_cache_dir
+from rate_limiter import parse_rate, parse_schedule
+
+logger = logging.getLogger("SpotifyDownloader")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download songs, playlists and albums from spotify using Spotifydown API.")
+    parser.add_argument("urls", nargs="*", help="spotify track, album or playlist urls")
+    parser.add_argument("-o", "--output", default=os.path.expanduser("~/Music"), help="output directory (default: ~/Music)")
+    parser.add_argument("--token", help="api token, defaults to the last token fetched by the cli")
+    parser.add_argument("--workers", type=int, default=4, help="tracks downloaded concurrently (default: 4)")
+    parser.add_argument("--max-per-host", type=int, default=0, help="max connections per host, 0 for no cap")
+    parser.add_argument("--api-rate", type=float, default=5.0, help="max api requests per second (default: 5)")
+    parser.add_argument("--bandwidth", type=parse_rate, default=0, help="cap on audio and cover downloads over all hosts, e.g. 2M for 2 MB/s (default: no cap)")
+    parser.add_argument("--host-bandwidth", type=parse_rate, default=0, help="cap per host, e.g. 500K (default: no cap)")
+    parser.add_argument("--bandwidth-schedule", type=parse_schedule, default=[], help="overall cap by local time of day, e.g. 09:00-18:00=500K,18:00-09:00=0 (0 for no cap)")
+    parser.add_argument("--token-ttl", type=int, default=300, help="seconds a token is trusted before refreshing it (default: 300)")
+    parser.add_argument("--token-pool", type=int, default=0, help="resolve download links with this many tokens side by side, kept across runs (default: a single token)")
+    parser.add_argument("--token-leases", type=int, default=0, help="with --token-pool, links resolved with one token at a time (default: no cap)")
+    parser.add_argument("--api-url", action="append", help="downloader api to use instead of api.spotifydown.com, e.g. a mock_api.py server. "
+        "Give it more than once to spread calls over several, slow calls are sent again to the next one")
+    parser.add_argument("--hedge-percentile", type=float, default=95, help="with several --api-url, resend a call once it took longer than this percentile of recent calls, or three times their median if that is sooner (default: 95)")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the metadata cache and always ask the api")
+    parser.add_argument("--cache-ttl", type=float, help="hours cached api responses are trusted (default: 30 days for tracks and albums, 6 hours for playlists). "
+        "Cached playlist and album track lists are checked against the api before every run either way")
+    parser.add_argument("--no-library", action="store_true", help="don't link tracks from other playlists and albums in the output directory, always download")
+    parser.add_argument("--headless", action=argparse.BooleanOptionalAction, default=True, help="run the token browser headless (default: yes)")
+    parser.add_argument("--watchlist", help="file with one url per line, optionally followed by a priority, synced with the urls given")
+    parser.add_argument("--interval", type=int, default=0, help="with --watchlist, sync again every this many seconds instead of exiting")
+    parser.add_argument("--syncs", type=int, default=2, help="with --watchlist, urls synced at the same time (default: 2)")
+    parser.add_argument("--download-budget", type=int, default=0, help="with --watchlist, downloads at the same time over all syncs (default: --workers)")
+    parser.add_argument("--full-sync-hours", type=float, default=24, help="with --watchlist, sync unchanged playlists anyway after this many hours (default: 24)")
+    parser.add_argument("--retag", action="store_true", help="rewrite the id3 tags of the tracks already downloaded for the urls, from their current metadata")
+    parser.add_argument("--verify", action="store_true", help="check the mp3 files downloaded into the output directory instead of downloading")
+    parser.add_argument("--requeue", action="store_true", help="with --verify, move bad files aside so the next sync downloads them again")
+    parser.add_argument("--profile", action="store_true", help="profile each run (cpu and allocations) and write the profile and a summary into the output directory")
+    parser.add_argument("--metrics-json", help="write phase timings, byte, retry and http status counts of the run to this json file")
+    parser.add_argument("--metrics-prom", help="write the same metrics as a prometheus textfile, e.g. into the node exporter's textfile directory")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only log warnings and errors")
+    args = parser.parse_args(argv)
+    if not args.urls and not args.watchlist and not args.verify:
+        parser.error("give urls, a --watchlist or --verify")
+    if args.retag and (args.watchlist or not args.urls):
+        parser.error("--retag works on the urls given")
+    return args
+
+
+def token_file():
+    return user_cache_dir() / "token"
+
+
+def load_token():
+    try:
+        return token_file().read_text().strip()
+    except OSError:
+        return ""
+
+
+def save_token(token):
+    token_file().write_text(token)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(asctime)s %(message)s")
+    if args.verify:
+        # needs neither the network nor eyed3
+        import verify
+        return 1 if verify.main(args.output, move_aside=args.requeue, log=logger.warning) else 0
+
+    import_start = time.perf_counter()
+    from spotify_scraper import SpotifyScraper, DOWNLOADER_URL
+    from http_client import HttpClient, API_HOST
+    from rate_limiter import RateLimiter, BandwidthLimiter
+    from cover_cache import CoverCache
+    from token_grabber import TokenProvider
+    from metadata_cache import MetadataCache, uniform_ttls
+    from metrics import RunMetrics
+    from api_endpoints import ApiEndpoints
+    from token_manager import TokenPool
+    logger.info(f"imports took {1000 * (time.perf_counter() - import_start):.0f} ms")
+
+    token = args.token or load_token()
+    http_client = HttpClient(pool_maxsize=max(10, args.workers), max_per_host=args.max_per_host or None,
+        rate_limiter=RateLimiter({API_HOST: args.api_rate}))
+    cover_cache = CoverCache(cache_dir=user_cache_dir("covers"))
+    token_provider = TokenProvider(headless=args.headless)
+    metadata_cache = None
+    if not args.no_cache:
+        ttls = uniform_ttls(args.cache_ttl * 60 * 60) if args.cache_ttl is not None else None
+        metadata_cache = MetadataCache(user_cache_dir() / "metadata.sqlite3", ttls=ttls)
+    logger.info(f"startup took {1000 * (time.perf_counter() - START_TIME):.0f} ms")
+
+    # one set of metrics and one bandwidth cap for all urls
+    metrics = RunMetrics()
+    bandwidth = BandwidthLimiter(args.bandwidth, args.host_bandwidth, args.bandwidth_schedule)
+    # latency stats per api url are kept across urls too
+    api_endpoints = ApiEndpoints(args.api_url or [DOWNLOADER_URL], hedge_percentile=args.hedge_percentile)
+
+    def fetch_pool_token():
+        try:
+            with metrics.timed("token"):
+                new_token = token_provider.get_token()
+        except Exception as exc:
+            logger.warning(f"failed to fetch a token: {str(exc)}")
+            return None
+        metrics.count("tokens_fetched", result="ok" if new_token else "empty")
+        return new_token
+
+    token_pool = None
+    if args.token_pool:
+        token_pool = TokenPool(fetch_pool_token, args.token_pool, ttl=args.token_ttl, max_leases=args.token_leases,
+            path=user_cache_dir() / "token_pool.json")
+
+    def token_updated(new_token):
+        # the next scraper starts from the freshest token
+        nonlocal token
+        token = new_token
+        save_token(new_token)
+
+    def make_scraper(url, **kwargs):
+        scraper = SpotifyScraper(url, token, args.output, max_workers=args.workers, http_client=http_client,
+            cover_cache=cover_cache, token_ttl=args.token_ttl, token_provider=token_provider, metadata_cache=metadata_cache,
+            use_library=not args.no_library, api_endpoints=api_endpoints, metrics=metrics, bandwidth=bandwidth,
+            token_pool=token_pool, profile=args.profile, **kwargs)
+        scraper.progress_updated.connect(logger.info)
+        scraper.token_updated.connect(token_updated)
+        return scraper
+
+    def write_metrics():
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+
+    failed = 0
+    try:
+        if args.watchlist:
+            failed = sync_watchlist(args, make_scraper, metrics, write_metrics)
+        else:
+            with metrics.cycle():
+                for url in args.urls:
+                    scraper = make_scraper(url)
+                    scraper.run(retag=args.retag)
+                    failed += scraper.failed_track_count()
+                    if scraper.run_error is not None:
+                        # nothing or not everything was attempted, cron should notice
+                        failed += 1
+    except KeyboardInterrupt:
+        logger.warning("interrupted")
+        failed += 1
+    finally:
+        if token_pool is not None:
+            logger.info(f"token pool: {token_pool.describe()}")
+            token_pool.close()
+        # only close the browser if a token was actually fetched
+        if token_provider.browser is not None:
+            token_provider.close()
+        api_endpoints.close()
+        http_client.close()
+        if metadata_cache is not None:
+            metadata_cache.close()
+        write_metrics()
+    return 1 if failed else 0
+
+
+def sync_watchlist(args, make_scraper, metrics, after_cycle):
+    from watchlist import WatchlistEntry, WatchlistState, WatchlistSync, WATCHLIST_STATE_FILENAME, load_watchlist
+
+    os.makedirs(args.output, exist_ok=True)
+    state = WatchlistState(os.path.join(args.output, WATCHLIST_STATE_FILENAME))
+    try:
+        while True:
+            # re-read every cycle, so urls can be added while the daemon runs
+            entries = load_watchlist(args.watchlist) + [WatchlistEntry(url) for url in args.urls]
+            sync = WatchlistSync(entries, state, make_scraper, max_syncs=args.syncs,
+                download_budget=args.download_budget or args.workers, full_sync_every=args.full_sync_hours * 60 * 60, log=logger.info)
+            start = time.monotonic()
+            with metrics.cycle():
+                failed = sync.run_cycle()
+            after_cycle()
+            if not args.interval:
+                return failed
+            time.sleep(max(0, args.interval - (time.monotonic() - start)))
+    finally:
+        state.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+
+class CoverCache:
+    # cover art keyed by url: an in memory LRU in front of an optional on-disk store.
+    # concurrent requests for the same url wait on a single fetch.
+
+    def __init__(self, max_items=64, cache_dir=None, max_disk_bytes=200*1024*1024):
+        self.max_items = max_items
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.disk_lock = threading.Lock()
+        self.disk_bytes = 0
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in self.cache_dir.glob("*.img"))
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def get(self, url, fetch):
+        key = self.key(url)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            data = self.read_disk(key)
+            if data is None:
+                data = fetch(url)
+                self.write_disk(key, data)
+            self.remember(key, data)
+            future.set_result(data)
+            return data
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def remember(self, key, data):
+        with self.lock:
+            self.memory[key] = data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def disk_path(self, key):
+        return self.cache_dir / f"{key}.img"
+
+    def read_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self.disk_path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        # mtime is used as last access time for eviction
+        os.utime(path)
+        return data
+
+    def write_disk(self, key, data):
+        if self.cache_dir is None:
+            return
+        path = self.disk_path(key)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        with self.disk_lock:
+            self.disk_bytes += len(data)
+            if self.disk_bytes > self.max_disk_bytes:
+                self.evict_disk()
+
+    def evict_disk(self):
+        # drop least recently used files until the store is back to 90% of its budget
+        entries = []
+        for entry in self.cache_dir.glob("*.img"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_disk_bytes * 0.9:
+                break
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.disk_bytes = total
@@ -0,0 +1,125 @@
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limiter import RateLimiter, THROTTLE_STATUSES, retry_after_seconds
+
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0'
+
+# Clean browser headers, built once and shared by every request.
+# The Host header is filled in by urllib3 from the url.
+BROWSER_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip',
+    'Referer': 'https://spotifydown.com/',
+    'Origin': 'https://spotifydown.com',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-GPC': '1'
+}
+
+API_HOST = 'api.spotifydown.com'
+
+# requests per second allowed by default, per host
+DEFAULT_RATES = {
+    API_HOST: 5.0
+}
+
+# headers for api.spotifydown.com
+API_HEADERS = dict(BROWSER_HEADERS, **{
+    'Sec-Fetch-Site': 'same-site',
+    'TE': 'trailers'
+})
+
+# headers for the audio and cover CDNs
+CDN_HEADERS = dict(BROWSER_HEADERS, **{
+    'Sec-Fetch-Site': 'cross-site'
+})
+
+# audio is fetched unencoded, so byte offsets for Range requests match the file
+AUDIO_HEADERS = dict(CDN_HEADERS, **{
+    'Accept-Encoding': 'identity'
+})
+
+
+def host_of(url):
+    return urlsplit(url).netloc
+
+
+class HostLimiter:
+    # caps the number of simultaneous connections per host, no cap if max_per_host is None
+
+    def __init__(self, max_per_host=None):
+        self.max_per_host = max_per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, host):
+        if not self.max_per_host:
+            yield
+            return
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            semaphore = self.semaphores[host]
+        with semaphore:
+            yield
+
+
+class HttpClient:
+    # one requests session shared by all workers, keeping connections alive per host.
+    # every request goes through the rate limiter, throttled requests are retried
+    # after the delay the server asked for.
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, connect_timeout=10, read_timeout=60, max_per_host=None,
+                 rate_limiter=None, max_retries=3):
+        self.timeout = (connect_timeout, read_timeout)
+        self.host_limiter = HostLimiter(max_per_host)
+        self.rate_limiter = rate_limiter or RateLimiter(DEFAULT_RATES)
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        # pool_connections is the number of hosts kept, pool_maxsize the connections kept per host
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _send(self, url, headers, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        host = host_of(url)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.before_request(host)
+            try:
+                resp = self.session.get(url, headers=headers, **kwargs)
+            except Exception:
+                self.rate_limiter.record(host)
+                raise
+            self.rate_limiter.record(host, resp.status_code, retry_after_seconds(resp.headers.get('Retry-After')))
+            if resp.status_code not in THROTTLE_STATUSES or attempt == self.max_retries:
+                return resp
+            resp.close()
+
+    def get(self, url, headers=CDN_HEADERS, **kwargs):
+        with self.host_limiter.slot(host_of(url)):
+            return self._send(url, headers, **kwargs)
+
+    @contextmanager
+    def stream(self, url, headers=CDN_HEADERS, **kwargs):
+        # the host slot is held until the body has been consumed
+        with self.host_limiter.slot(host_of(url)):
+            resp = self._send(url, headers, stream=True, **kwargs)
+            try:
+                yield resp
+            finally:
+                resp.close()
+
+    def close(self):
+        self.session.close()
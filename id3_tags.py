@@ -0,0 +1,92 @@
+import os
+import shutil
+
+# id3 tags are rendered in memory and written in front of the audio stream,
+# so a download is written to disk exactly once.
+# eyed3 is only imported to render a tag, the rest is used by verify.py as well.
+
+ID3_HEADER_SIZE = 10
+
+
+def render_tag(track, cover=None, fit_size=0):
+    # with fit_size, the tag is padded to exactly that size if it fits
+    from eyed3.id3 import Tag, ID3_V2_3
+    from eyed3.id3.frames import ImageFrame
+    
+    tag = Tag(version=ID3_V2_3)
+    tag.album = track.album
+    tag.artist = track.artist
+    tag.title = track.title
+    tag.recording_date = track.releaseDate
+    tag.track_num = track.track_number
+    if cover:
+        tag.images.set(ImageFrame.FRONT_COVER, cover, 'image/jpeg')
+    # Tag.save only writes to files, _render is what it uses to build the bytes (eyed3 is pinned in requirements.txt)
+    _, tag_data, padding = tag._render(ID3_V2_3, fit_size, None)
+    return tag_data + padding
+
+
+def id3v2_size(header):
+    # total size of the id3v2 tag starting with header, 0 if there is none
+    if len(header) < ID3_HEADER_SIZE or header[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7f)
+    footer = ID3_HEADER_SIZE if header[5] & 0x10 else 0
+    return ID3_HEADER_SIZE + size + footer
+
+
+def strip_id3v2(chunks, on_skip=None):
+    # yields the audio stream without the id3v2 tag it may start with,
+    # on_skip is told how many bytes were dropped before the first audio byte
+    head = b""
+    chunks = iter(chunks)
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= ID3_HEADER_SIZE:
+            break
+    skip = id3v2_size(head)
+    if on_skip is not None:
+        on_skip(skip)
+    while skip and head:
+        if len(head) > skip:
+            head = head[skip:]
+            skip = 0
+        else:
+            skip -= len(head)
+            head = next(chunks, b"")
+    if head:
+        yield head
+    yield from chunks
+
+
+def retag_file(path, track, cover=None, buffer_size=1024*1024):
+    # replaces the id3v2 tag of the mp3 at path, the audio bytes are not touched.
+    # returns "unchanged", "in place" when the new tag fit in the old one's space,
+    # or "rewritten" when the file had to be written again.
+    with open(path, 'r+b') as fp:
+        old_size = id3v2_size(fp.read(ID3_HEADER_SIZE))
+        tag_data = render_tag(track, cover, fit_size=old_size)
+        if len(tag_data) == old_size:
+            fp.seek(0)
+            if fp.read(old_size) == tag_data:
+                return "unchanged"
+            # a hardlinked file (see library_store.py) is shared with other folders,
+            # writing it in place would retag the track there too
+            if os.fstat(fp.fileno()).st_nlink == 1:
+                fp.seek(0)
+                fp.write(tag_data)
+                return "in place"
+        # the new tag is larger or the file is shared, write it and the audio to a new file
+        part_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.retag.part")
+        fp.seek(old_size)
+        try:
+            with open(part_path, 'wb') as part_fp:
+                part_fp.write(tag_data)
+                shutil.copyfileobj(fp, part_fp, buffer_size)
+        except BaseException:
+            os.remove(part_path)
+            raise
+    os.replace(part_path, path)
+    return "rewritten"
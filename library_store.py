@@ -0,0 +1,159 @@
+import os
+import platform
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+LIBRARY_DIRNAME = ".library"
+
+# linux ioctl to clone a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def reflink(source, dest):
+    # copy-on-write clone, raises OSError where the filesystem can't do it
+    system = platform.system()
+    if system == "Linux":
+        import fcntl
+        with open(source, 'rb') as src, open(dest, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                dst.close()
+                os.remove(dest)
+                raise
+    elif system == "Darwin":
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(source), os.fsencode(dest), 0) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    else:
+        raise OSError(f"reflinks are not supported on {system}")
+
+
+def link_or_copy(source, dest):
+    # cheapest way to get the same bytes at dest: hardlink, then reflink, then a plain copy
+    try:
+        os.link(source, dest)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        reflink(source, dest)
+        return "reflink"
+    except OSError:
+        pass
+    shutil.copy2(source, dest)
+    return "copy"
+
+
+class LibraryStore:
+    # library wide index of downloaded tracks keyed by spotify track id.
+    # objects/ holds one hardlink (or reflink) per track, so a track is only
+    # downloaded once whatever the number of playlists and albums it is in.
+    # where neither is possible the index points at the first downloaded file instead.
+
+    def __init__(self, root):
+        self.root = Path(root) / LIBRARY_DIRNAME
+        self.objects = self.root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.root / "index.sqlite3"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS objects (
+                id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER,
+                checksum TEXT,
+                added_at REAL NOT NULL)""")
+
+    def object_path(self, track_id):
+        return self.objects / track_id[:2] / f"{track_id}.mp3"
+
+    def get(self, track_id):
+        # path of the stored track, None if the library does not have it (anymore)
+        with self.lock:
+            row = self.db.execute("SELECT path FROM objects WHERE id = ?", (track_id,)).fetchone()
+        if row is None:
+            return None
+        path = Path(row[0])
+        if not path.exists():
+            with self.lock, self.db:
+                self.db.execute("DELETE FROM objects WHERE id = ?", (track_id,))
+            return None
+        return path
+
+    def ids(self):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT id FROM objects")}
+
+    def add(self, track_id, source, size=None, checksum=None):
+        path = self.object_path(track_id)
+        path.parent.mkdir(exist_ok=True)
+        try:
+            if path.exists():
+                path.unlink()
+            os.link(source, path)
+        except OSError:
+            try:
+                reflink(source, path)
+            except OSError:
+                # no cheap copy here, remember where the file is instead of storing a second one
+                path = Path(source)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO objects (id, path, size, checksum, added_at) VALUES (?, ?, ?, ?, ?)",
+                (track_id, str(path), size, checksum, time.time()))
+
+    def remove(self, track_id):
+        # forgets a track, e.g. one found corrupt, so it gets downloaded again
+        path = self.object_path(track_id)
+        if path.exists():
+            path.unlink()
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM objects WHERE id = ?", (track_id,))
+
+    def materialize(self, track_id, dest):
+        # puts the stored track at dest, returns how ("hardlink", "reflink", "copy") or None if it is not stored
+        source = self.get(track_id)
+        if source is None:
+            return None
+        if os.path.exists(dest):
+            if os.path.samefile(source, dest):
+                # the index points at dest itself, nothing to link from
+                return None
+            os.remove(dest)
+        return link_or_copy(source, dest)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class InflightDownloads:
+    # track ids downloaded by any of the scrapers sharing this during one sync cycle,
+    # so a track in several playlists is only fetched by the first one to get to it
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}
+
+    def claim(self, track_id):
+        # None if the caller should download the track, otherwise an event set once the download is over
+        with self.lock:
+            event = self.events.get(track_id)
+            if event is None:
+                self.events[track_id] = threading.Event()
+            return event
+
+    def release(self, track_id):
+        # the event stays, later claims in this cycle return at once
+        with self.lock:
+            event = self.events.get(track_id)
+            if event is None:
+                # never claimed (no library to share through), nobody waits for it
+                return
+            event.set()
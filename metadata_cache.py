@@ -0,0 +1,89 @@
+import json
+import sqlite3
+import threading
+import time
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# seconds a cached response stays valid, by endpoint prefix.
+# endpoints without a ttl (e.g. /download) are never cached.
+DEFAULT_TTLS = {
+    "/metadata/track/": 30 * DAY,
+    "/metadata/album/": 30 * DAY,
+    "/metadata/playlist/": 6 * HOUR,
+    "/trackList/album/": 30 * DAY,
+    "/trackList/playlist/": 6 * HOUR,
+}
+
+
+def uniform_ttls(seconds):
+    # the same ttl for every cached endpoint, e.g. from --cache-ttl
+    return dict.fromkeys(DEFAULT_TTLS, seconds)
+
+
+class MetadataCache:
+    # persistent cache of downloader api json responses, keyed by endpoint.
+    # least recently used entries are evicted once max_entries is reached.
+
+    def __init__(self, path, ttls=None, max_entries=20000):
+        self.ttls = dict(DEFAULT_TTLS if ttls is None else ttls)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                endpoint TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def ttl(self, endpoint):
+        for prefix, ttl in self.ttls.items():
+            if endpoint.startswith(prefix):
+                return ttl
+        return None
+
+    def is_cacheable(self, endpoint):
+        return self.ttl(endpoint) is not None
+
+    def get(self, endpoint):
+        ttl = self.ttl(endpoint)
+        if ttl is None:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT data, stored_at FROM responses WHERE endpoint = ?", (endpoint,)).fetchone()
+            if row is None:
+                return None
+            data, stored_at = row
+            if now - stored_at > ttl:
+                with self.db:
+                    self.db.execute("DELETE FROM responses WHERE endpoint = ?", (endpoint,))
+                return None
+            with self.db:
+                self.db.execute("UPDATE responses SET accessed_at = ? WHERE endpoint = ?", (now, endpoint))
+        return json.loads(data)
+
+    def put(self, endpoint, data):
+        if not self.is_cacheable(endpoint):
+            return
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO responses (endpoint, data, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (endpoint, json.dumps(data), now, now))
+            count = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                # evict down to 90% so this does not run on every insert
+                self.db.execute("""DELETE FROM responses WHERE endpoint IN (
+                    SELECT endpoint FROM responses ORDER BY accessed_at LIMIT ?)""", (count - int(self.max_entries * 0.9),))
+
+    def invalidate(self, prefix=""):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM responses WHERE endpoint LIKE ? ESCAPE '\\'",
+                (prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%",))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# upper bounds in seconds of the phase duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+METRIC_PREFIX = "spotifydownloader"
+
+
+class PhaseStats:
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(DURATION_BUCKETS)
+
+    def observe(self, seconds, error=False):
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+    def cumulative_buckets(self):
+        total = 0
+        for bound, count in zip(DURATION_BUCKETS, self.buckets):
+            total += count
+            yield bound, total
+
+
+class RunMetrics:
+    # time spent per phase (token, api, cover, tag, audio, ...), counters such as
+    # bytes and retries, and http statuses per endpoint. Shared by all workers,
+    # and by all scrapes of a cli run, then exported as json or a prometheus textfile.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        # start and end of the last run over all urls (a watchlist cycle in daemon mode)
+        self.cycle_started_at = None
+        self.cycle_finished_at = None
+        self.cycles = 0
+        self.phases = {}
+        # (name, sorted label items) -> value
+        self.counters = Counter()
+
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(phase, time.perf_counter() - start, error)
+
+    @contextmanager
+    def cycle(self):
+        # an interrupted cycle is not recorded, the last finished one stays
+        started_at = time.time()
+        yield
+        with self.lock:
+            self.cycle_started_at = started_at
+            self.cycle_finished_at = time.time()
+            self.cycles += 1
+
+    def last_cycle(self):
+        # (start, end) of the last finished cycle, before the first one the run so far
+        if self.cycle_finished_at is None:
+            return self.started_at, time.time()
+        return self.cycle_started_at, self.cycle_finished_at
+
+    def observe(self, phase, seconds, error=False):
+        with self.lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = PhaseStats()
+            stats.observe(seconds, error)
+
+    def count(self, name, amount=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def status(self, endpoint, status_code):
+        # status_code None for requests that got no response
+        self.count("http_responses", endpoint=endpoint, status=str(status_code or "none"))
+
+    def summary(self):
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                key = name + "".join(f",{label}={value}" for label, value in labels)
+                counters[key] = value
+            cycle_started_at, cycle_finished_at = self.last_cycle()
+            return {
+                "started_at": self.started_at,
+                "duration_seconds": round(time.time() - self.started_at, 3),
+                "cycles": self.cycles,
+                "last_cycle": {
+                    "started_at": cycle_started_at,
+                    "finished_at": cycle_finished_at,
+                    "duration_seconds": round(cycle_finished_at - cycle_started_at, 3),
+                },
+                "phases": {phase: {
+                    "count": stats.count,
+                    "errors": stats.errors,
+                    "total_seconds": round(stats.total, 3),
+                    "mean_seconds": round(stats.total / stats.count, 4) if stats.count else None,
+                    "max_seconds": round(stats.max, 4),
+                } for phase, stats in sorted(self.phases.items())},
+                "counters": counters,
+            }
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            lines.append(f"# HELP {METRIC_PREFIX}_phase_duration_seconds Time spent per phase of a run.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_phase_duration_seconds histogram")
+            for phase, stats in sorted(self.phases.items()):
+                for bound, count in stats.cumulative_buckets():
+                    lines.append(f'{METRIC_PREFIX}_phase_duration_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+                lines.append(f'{METRIC_PREFIX}_phase_duration_seconds_bucket{{phase="{phase}",le="+Inf"}} {stats.count}')
+                lines.append(f'{METRIC_PREFIX}_phase_duration_seconds_sum{{phase="{phase}"}} {stats.total:.6f}')
+                lines.append(f'{METRIC_PREFIX}_phase_duration_seconds_count{{phase="{phase}"}} {stats.count}')
+            lines.append(f"# HELP {METRIC_PREFIX}_phase_errors_total Phases that ended with an error.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_phase_errors_total counter")
+            for phase, stats in sorted(self.phases.items()):
+                lines.append(f'{METRIC_PREFIX}_phase_errors_total{{phase="{phase}"}} {stats.errors}')
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f"{METRIC_PREFIX}_{name}_total"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                label_text = ",".join(f'{label}="{value}"' for label, value in labels)
+                lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+            cycle_started_at, cycle_finished_at = self.last_cycle()
+            cycles = self.cycles
+        lines.append(f"# HELP {METRIC_PREFIX}_last_run_start_timestamp_seconds When the last run (watchlist cycle) started.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_last_run_start_timestamp_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}_last_run_start_timestamp_seconds {cycle_started_at:.0f}")
+        lines.append(f"# HELP {METRIC_PREFIX}_last_run_timestamp_seconds When the last run (watchlist cycle) finished.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_last_run_timestamp_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}_last_run_timestamp_seconds {cycle_finished_at:.0f}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}_run_duration_seconds {cycle_finished_at - cycle_started_at:.3f}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_runs_total counter")
+        lines.append(f"{METRIC_PREFIX}_runs_total {cycles}")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path):
+        # the node exporter must never read a half written file
+        write_atomic(path, self.prometheus())
+
+
+def write_atomic(path, text):
+    part = f"{path}.part"
+    with open(part, "w") as fp:
+        fp.write(text)
+    os.replace(part, path)
@@ -0,0 +1,207 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+# Local stand-in for the downloader api and its cdns, used by benchmark.py.
+# Entity ids end with their track count: /metadata/playlist/bench5000 is a
+# playlist of 5000 tracks, the first 50 of which are also in bench50. Latency,
+# a slow tail, errors, rejected tokens (403 in the json body, like the real
+# api), per token quotas and rates and throttling (429 with Retry-After) can be injected.
+
+# one silent mpeg 1 layer 3 frame, 128 kbps 44.1 kHz
+MP3_FRAME = b"\xff\xfb\x90\x00" + b"\x00" * 413
+COVER = b"\xff\xd8\xff\xe0" + b"\x00" * 20 * 1024
+
+
+def track_count(entity_id):
+    match = re.search(r"(\d+)$", entity_id)
+    return int(match.group(1)) if match else 1
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send(200, json.dumps(data).encode())
+
+    def do_GET(self):
+        api = self.server.api
+        url = urlsplit(self.path)
+        endpoint = "/" + url.path.split("/")[1]
+        api.count(endpoint)
+        api.delay()
+        status = api.injected_status()
+        if status is not None:
+            api.count(f"injected {status}")
+            self.send(status, b"{}", headers={"Retry-After": str(api.retry_after)} if status == 429 else None)
+            return
+        base = f"http://{self.headers['Host']}"
+        parts = url.path.split("/")
+        if endpoint == "/metadata" and len(parts) == 4:
+            self.send_json(api.metadata(parts[2], parts[3], base))
+        elif endpoint == "/trackList" and len(parts) == 4:
+            offset = int(parse_qs(url.query).get("offset", ["0"])[0])
+            self.send_json(api.track_list(parts[2], parts[3], offset, base))
+        elif endpoint == "/download" and len(parts) == 3:
+            token = parse_qs(url.query).get("token", [""])[0]
+            api.token_delay(token)
+            if api.reject_token(token):
+                api.count("injected 403")
+                self.send_json({"success": False, "statusCode": 403, "message": "Token expired"})
+            else:
+                self.send_json({"success": True, "link": f"{base}/audio/{parts[2]}.mp3"})
+        elif endpoint == "/audio":
+            self.send_audio(api.audio)
+        elif endpoint == "/cover":
+            self.send(200, COVER, "image/jpeg")
+        else:
+            self.send(404, b"{}")
+
+    def send_audio(self, audio):
+        headers = {"ETag": '"bench"', "Accept-Ranges": "bytes"}
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and int(match.group(1)) < len(audio):
+            start = int(match.group(1))
+            headers["Content-Range"] = f"bytes {start}-{len(audio) - 1}/{len(audio)}"
+            self.send(206, audio[start:], "audio/mpeg", headers)
+        else:
+            self.send(200, audio, "audio/mpeg", headers)
+
+
+class MockApi:
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, forbidden_rate=0.0,
+                 retry_after=1, audio_size=256*1024, page_size=100, seed=None, slow_rate=0.0, slow_latency=1.0,
+                 token_quota=0, token_interval=0.0):
+        # seconds added to every request, plus up to jitter seconds
+        self.latency = latency
+        self.jitter = jitter
+        # share of requests taking slow_latency seconds more
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        # share of requests answered with a 500, a 429 or (for /download) a rejected token
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.forbidden_rate = forbidden_rate
+        self.retry_after = retry_after
+        # /download calls a token is good for, 0 for no limit
+        self.token_quota = token_quota
+        self.token_uses = Counter()
+        # seconds between two /download calls with the same token, later calls wait their turn
+        self.token_interval = token_interval
+        self.token_next = {}
+        self.audio = MP3_FRAME * max(1, audio_size // len(MP3_FRAME))
+        self.page_size = page_size
+        # entity id: track count, overriding the one in the id, to change a playlist between syncs
+        self.track_counts = {}
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, port=0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def chance(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self.lock:
+                jitter = self.random.uniform(0, self.jitter)
+            time.sleep(self.latency + jitter)
+        if self.chance(self.slow_rate):
+            self.count("injected slow")
+            time.sleep(self.slow_latency)
+
+    def injected_status(self):
+        if self.chance(self.error_rate):
+            return 500
+        if self.chance(self.throttle_rate):
+            return 429
+        return None
+
+    def token_delay(self, token):
+        if not self.token_interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.token_next.get(token, now))
+            self.token_next[token] = start + self.token_interval
+        time.sleep(start - now)
+
+    def reject_token(self, token):
+        if self.token_quota:
+            with self.lock:
+                self.token_uses[token] += 1
+                if self.token_uses[token] > self.token_quota:
+                    return True
+        return self.chance(self.forbidden_rate)
+
+    def track(self, entity_type, entity_id, index, base):
+        # playlists share their tracks, like real ones do
+        track_id = f"track{index}" if entity_type == "playlist" else f"{entity_id}x{index}"
+        return {
+            "id": track_id,
+            "title": f"Track {index}",
+            "artists": [f"Artist {index % 50}"],
+            "album": entity_id if entity_type == "album" else f"Album {index % 200}",
+            "cover": f"{base}/cover/{entity_id if entity_type == 'album' else index % 200}.jpg",
+            "releaseDate": "2020-01-01",
+            "trackNumber": index + 1,
+        }
+
+    def metadata(self, entity_type, entity_id, base):
+        if entity_type == "track":
+            return dict(self.track("track", entity_id, 0, base), success=True)
+        return {
+            "success": True,
+            "title": f"Bench {entity_type} {entity_id}",
+            "artists": ["Bench"],
+            "cover": f"{base}/cover/{entity_id}.jpg",
+        }
+
+    def track_list(self, entity_type, entity_id, offset, base):
+        count = self.track_counts.get(entity_id, track_count(entity_id))
+        end = min(count, offset + self.page_size)
+        data = {"success": True, "trackList": [self.track(entity_type, entity_id, index, base) for index in range(offset, end)]}
+        if end < count:
+            data["nextOffset"] = end
+        return data
@@ -0,0 +1,140 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+# Profiles a whole scrape run: cProfile over the thread running it and the
+# callables it hands to its worker threads (see wrap), and tracemalloc
+# snapshots at its start and end. Writes a .prof file (for
+# snakeviz, pstats, ...) and a text summary of the hottest functions and the
+# biggest allocation sites into the output folder.
+
+PROFILE_TOP = 30
+# frames kept per allocation, enough to see which caller allocated
+TRACEMALLOC_FRAMES = 10
+
+# profilers hook the whole interpreter, so only one run is profiled at a time
+_active = threading.Lock()
+
+
+class RunProfiler:
+
+    def __init__(self, directory, top=PROFILE_TOP, log=print):
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.directory = Path(directory)
+        self.prof_path = self.directory / f"spotifydownloader-profile-{stamp}.prof"
+        self.summary_path = self.directory / f"spotifydownloader-profile-{stamp}.txt"
+        self.top = top
+        self.log = log
+        self.active = False
+        self.profile = None
+        # worker thread id: profile, before python 3.12. Only one profiler per thread
+        # is enabled at a time, running holds the threads inside a wrapped call.
+        self.thread_profiles = {}
+        self.running = set()
+        self.lock = threading.Lock()
+        self.started_tracing = False
+        self.start_snapshot = None
+        self.started_at = None
+
+    def __enter__(self):
+        if not _active.acquire(blocking=False):
+            self.log("another run is being profiled, not profiling this one")
+            return self
+        self.active = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.started_tracing = True
+        tracemalloc.reset_peak()
+        self.start_snapshot = tracemalloc.take_snapshot()
+        self.started_at = time.perf_counter()
+        self.profile = cProfile.Profile()
+        # from 3.12 on cprofile uses sys.monitoring, which sees every thread while it is enabled
+        self.profile.enable()
+        return self
+
+    def wrap(self, fn):
+        # fn profiled on whichever worker thread runs it, while the run is being profiled.
+        # Threads not running a wrapped callable (other runs, pools of the gui) are left alone.
+        if not self.active or sys.version_info >= (3, 12):
+            return fn
+
+        def profiled(*args, **kwargs):
+            ident = threading.get_ident()
+            with self.lock:
+                if not self.active or ident in self.running:
+                    profile = None
+                else:
+                    profile = self.thread_profiles.setdefault(ident, cProfile.Profile())
+                    self.running.add(ident)
+            if profile is None:
+                return fn(*args, **kwargs)
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.running.discard(ident)
+        return profiled
+
+    def __exit__(self, *exc_info):
+        if not self.active:
+            return
+        try:
+            self.profile.disable()
+            with self.lock:
+                self.active = False
+            seconds = time.perf_counter() - self.started_at
+            end_snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if self.started_tracing:
+                tracemalloc.stop()
+            self.write(seconds, end_snapshot, peak)
+            self.log(f"profile written to {self.prof_path}, summary in {self.summary_path}")
+        except Exception as exc:
+            self.log(f"could not write the profile: {str(exc)}")
+        finally:
+            _active.release()
+
+    def stats(self):
+        # a wrapped call still running after the run (it was not waited for) is left out
+        stats = pstats.Stats(self.profile)
+        with self.lock:
+            finished = [profile for ident, profile in self.thread_profiles.items() if ident not in self.running]
+            running = len(self.running)
+        for profile in finished:
+            stats.add(profile)
+        return stats, len(finished), running
+
+    def write(self, seconds, end_snapshot, peak):
+        os.makedirs(self.directory, exist_ok=True)
+        stats, threads, running = self.stats()
+        stats.dump_stats(self.prof_path)
+        out = io.StringIO()
+        out.write(f"run took {seconds:.1f}s, profiled {threads + 1} threads")
+        if running:
+            out.write(f" ({running} still running left out)")
+        out.write(f"\npeak traced memory {peak / (1024 * 1024):.1f} MB\n")
+
+        stats.stream = out
+        for sort in ("cumulative", "tottime"):
+            out.write(f"\n\ntop {self.top} functions by {sort} time\n")
+            stats.sort_stats(sort).print_stats(self.top)
+
+        ignored = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+        growth = end_snapshot.filter_traces(ignored).compare_to(self.start_snapshot.filter_traces(ignored), "lineno")
+        out.write(f"\n\ntop {self.top} allocation sites by memory held at the end of the run\n")
+        for stat in growth[:self.top]:
+            out.write(f"{stat}\n")
+        self.summary_path.write_text(out.getvalue())
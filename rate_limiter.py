@@ -0,0 +1,257 @@
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# statuses that mean "slow down" rather than "this request is wrong"
+THROTTLE_STATUSES = (429, 503)
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(value):
+    # Retry-After is either a number of seconds or an http date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    # rate tokens per second, up to burst at once. Callers reserve tokens
+    # under the lock and sleep outside of it, so waiting callers queue up fairly.
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1.0):
+        # returns how long the caller has to wait before using amount tokens
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self, amount=1.0):
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate, burst=None):
+        # tokens already reserved stay reserved
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.rate = rate
+            self.burst = burst if burst is not None else max(1.0, rate)
+            self.tokens = min(self.tokens, self.burst)
+
+
+class HostState:
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.failures = 0
+        # no request goes out before paused_until (Retry-After, backoff or an open circuit)
+        self.paused_until = 0.0
+        self.circuit_open = False
+        self.probing = False
+
+
+class RateLimiter:
+    # shared by all workers: per host request rates, pauses after throttling
+    # responses and a circuit breaker that holds a failing host back for a while
+    # instead of letting every track burn its retries against it.
+
+    def __init__(self, rates=None, failure_threshold=5, cooldown=30.0, max_cooldown=300.0):
+        # requests per second by host, hosts not listed are not rate limited
+        self.rates = dict(rates or {})
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def host_state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            rate = self.rates.get(host)
+            state = self.hosts[host] = HostState(TokenBucket(rate) if rate else None)
+        return state
+
+    def before_request(self, host):
+        with self.lock:
+            state = self.host_state(host)
+            while True:
+                wait = state.paused_until - time.monotonic()
+                if wait > 0:
+                    self.changed.wait(wait)
+                elif state.circuit_open:
+                    if state.probing:
+                        # someone else is checking whether the host is back
+                        self.changed.wait()
+                    else:
+                        state.probing = True
+                        break
+                else:
+                    break
+            bucket = state.bucket
+        if bucket is not None:
+            bucket.acquire()
+
+    def record(self, host, status_code=None, retry_after=None):
+        # status_code None means the request failed without a response
+        with self.lock:
+            state = self.host_state(host)
+            state.probing = False
+            if status_code is not None and status_code < 500 and status_code not in THROTTLE_STATUSES:
+                state.failures = 0
+                state.circuit_open = False
+                self.changed.notify_all()
+                return
+            state.failures += 1
+            if state.failures >= self.failure_threshold:
+                state.circuit_open = True
+                pause = min(self.max_cooldown, self.cooldown * 2 ** (state.failures - self.failure_threshold))
+                if retry_after is not None:
+                    pause = max(pause, retry_after)
+            elif retry_after is not None:
+                # the server said when to come back
+                pause = retry_after
+            else:
+                pause = backoff_delay(state.failures)
+            state.paused_until = max(state.paused_until, time.monotonic() + pause)
+            self.changed.notify_all()
+
+    def is_open(self, host):
+        with self.lock:
+            return self.host_state(host).circuit_open
+
+
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(text):
+    # bytes per second from e.g. "500K", "2M" or "1.5MB/s", 0 means no cap
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:I?B)?(?:/S)?\s*", text.upper())
+    if match is None:
+        raise ValueError(f"not a rate: {text}")
+    return float(match.group(1)) * RATE_UNITS[match.group(2)]
+
+
+def parse_schedule(text):
+    # "09:00-18:00=500K,18:00-09:00=2M" -> [(start minute, end minute, bytes per second)].
+    # windows may wrap around midnight, the first one matching wins.
+    schedule = []
+    for window in filter(None, (part.strip() for part in text.split(","))):
+        match = re.fullmatch(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(.+)", window)
+        if match is None:
+            raise ValueError(f"not a schedule window: {window}, expected HH:MM-HH:MM=rate")
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        schedule.append((start, end, parse_rate(match.group(5))))
+    return schedule
+
+
+def format_rate(rate):
+    if rate < 1024 * 1024:
+        return f"{rate / 1024:.0f} KB/s"
+    return f"{rate / (1024 * 1024):.1f} MB/s"
+
+
+class BandwidthLimiter:
+    # caps the bytes per second of audio and cover transfers, over all of them and
+    # per host. Every transfer reserves each chunk it reads before reading the next,
+    # and the token buckets serve reservations in order, so transfers in flight get
+    # an even share of the cap. A schedule can change the global cap by time of day.
+    # Also measures the throughput actually achieved.
+
+    def __init__(self, rate=0, per_host=0, schedule=None):
+        # bytes per second, 0 for no cap
+        self.default_rate = rate
+        self.per_host = per_host
+        self.schedule = schedule or []
+        self.rate = None
+        self.bucket = None
+        self.host_buckets = {}
+        self.schedule_checked_at = None
+        self.transferred = 0
+        self.measured_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def scheduled_rate(self, now=None):
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+        return self.default_rate
+
+    def update_rate(self):
+        # the schedule is looked at once a minute at most
+        now = time.monotonic()
+        if self.schedule_checked_at is not None and now - self.schedule_checked_at < 60:
+            return
+        self.schedule_checked_at = now
+        rate = self.scheduled_rate()
+        if rate == self.rate:
+            return
+        self.rate = rate
+        if not rate:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate)
+        else:
+            self.bucket.set_rate(rate)
+
+    def consume(self, host, amount):
+        # called with the size of each chunk read, sleeps as long as the caps require
+        with self.lock:
+            self.update_rate()
+            self.transferred += amount
+            bucket = self.bucket
+            host_bucket = None
+            if self.per_host:
+                host_bucket = self.host_buckets.get(host)
+                if host_bucket is None:
+                    host_bucket = self.host_buckets[host] = TokenBucket(self.per_host)
+        wait = max(bucket.reserve(amount) if bucket is not None else 0.0,
+                   host_bucket.reserve(amount) if host_bucket is not None else 0.0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def take_throughput(self):
+        # bytes per second since the previous call
+        with self.lock:
+            now = time.monotonic()
+            rate = self.transferred / max(now - self.measured_at, 1e-6)
+            self.transferred = 0
+            self.measured_at = now
+            return rate
+
+    def describe(self):
+        with self.lock:
+            self.update_rate()
+            caps = []
+            if self.rate:
+                caps.append(f"{format_rate(self.rate)} overall")
+            if self.per_host:
+                caps.append(f"{format_rate(self.per_host)} per host")
+            return ", ".join(caps) or "no cap"
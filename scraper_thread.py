@@ -0,0 +1,50 @@
+import threading
+
+from PyQt6.QtCore import pyqtSignal, QThread
+
+from spotify_scraper import SpotifyScraper
+
+
+class SpotifyScraperThread(QThread):
+    # runs a SpotifyScraper off the GUI thread. Status messages, track updates
+    # and counts are buffered here and picked up in batches by the GUI with
+    # take_updates, instead of one Qt signal per event.
+    
+    token_updated = pyqtSignal(str)
+    
+    
+    def __init__(self, link, token, output_path, **kwargs):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.messages = []
+        self.updated_tracks = {}
+        self.latest_counts = None
+        self.scraper = SpotifyScraper(link, token, output_path, **kwargs)
+        self.scraper.counts.connect(self.buffer_counts)
+        self.scraper.token_updated.connect(self.token_updated.emit)
+        self.scraper.progress_updated.connect(self.buffer_message)
+        self.scraper.track_updated.connect(self.buffer_track)
+    
+    def run(self):
+        self.scraper.run()
+    
+    def buffer_message(self, message):
+        with self.lock:
+            self.messages.append(message)
+    
+    def buffer_track(self, track):
+        # a track updated many times between two batches is only sent once
+        with self.lock:
+            self.updated_tracks[id(track)] = track
+    
+    def buffer_counts(self, *counts):
+        with self.lock:
+            self.latest_counts = counts
+    
+    def take_updates(self):
+        # returns (messages, tracks, counts) accumulated since the last call
+        with self.lock:
+            messages, self.messages = self.messages, []
+            tracks, self.updated_tracks = list(self.updated_tracks.values()), {}
+            counts, self.latest_counts = self.latest_counts, None
+        return messages, tracks, counts
@@ -1,50 +1,84 @@
-import asyncio
+import hashlib
 import json
 import re
 import requests
 import signal
+import sqlite3
 import sys
 import traceback
 from pathlib import Path
+import time
 from time import sleep
 import os
 import platform
 from unidecode import unidecode
 from dataclasses import dataclass
-import random
-
-from PyQt6.QtCore import pyqtSignal, QThread
-
-import eyed3
-from eyed3.id3 import ID3_V2_3
-from eyed3.id3.frames import ImageFrame
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 
+# eyed3 is imported when the first track gets downloaded, see download_track
 # Suppress warnings about CRC fail for cover art
 import logging
 logging.getLogger('eyed3.mp3.headers').warning = logging.debug
 
-from token_grabber import main as get_token
+from token_grabber import default_provider
+from http_client import HttpClient, API_HEADERS, AUDIO_HEADERS, host_of
+from cover_cache import CoverCache
+from token_manager import TokenManager, TokenError
+from rate_limiter import backoff_delay, BandwidthLimiter, format_rate
+from sync_state import SyncState, SYNC_STATE_FILENAME, DOWNLOADING, DONE, FAILED, file_checksum
+from library_store import LibraryStore
+from metrics import RunMetrics
+from api_endpoints import ApiEndpoints
+
+
+# track states
+QUEUED = "queued"
+DOWNLOADED = "downloaded"
+SKIPPED = "skipped"
+FAILED_STATE = "failed"
+
+VALID_FILENAME_CHARS = frozenset("-_.() '',")
+
+# seconds between two throughput messages
+THROUGHPUT_REPORT_INTERVAL = 10
+
+DOWNLOADER_URL = "https://api.spotifydown.com"
 
 
 class SpotifySong:
-    # meta data
-    id: str
-    title: str = None
-    artist: str = None
-    album: str = None
-    cover: str = None
-    releaseDate: str = None
-    link: str = None
-    track_number: int = None
-    # state
-    downloaded: bool = False
-    skipped: bool = False
-    failed: bool = False
-    error: str = None
-    in_album: bool = False
-    
-    def __init__(self, data = None):
-        self.parse(data)
+    # slots keep a track small, large libraries hold tens of thousands of them
+    __slots__ = (
+        # meta data
+        "id", "title", "artist", "album", "cover", "releaseDate", "link", "track_number", "in_album",
+        # state, only changed through SpotifyScraper.set_track_state so the run counters stay right
+        "state", "error",
+        # progress, shown in the track table
+        "phase", "bytes_downloaded", "started_at", "finished_at",
+        # name and filename are computed once
+        "_name", "_filename",
+    )
+    
+    def __init__(self, data = None, album_cover=None, track_number=None, in_album=False):
+        self.id = None
+        self.title = None
+        self.artist = None
+        self.album = None
+        self.cover = None
+        self.releaseDate = None
+        self.link = None
+        self.track_number = None
+        self.in_album = in_album
+        self.state = QUEUED
+        self.error = None
+        self.phase = "queued"
+        self.bytes_downloaded = 0
+        self.started_at = None
+        self.finished_at = None
+        self._name = None
+        self._filename = None
+        self.parse(data, album_cover, track_number)
     
     def parse(self, data, album_cover=None, track_number=None):
         if 'id' in data:
@@ -70,54 +104,138 @@ class SpotifySong:
         else:
             if 'trackNumber' in data:
                 self.track_number = data["trackNumber"]
+        self._name = None
+        self._filename = None
+    
+    @property
+    def downloaded(self):
+        return self.state == DOWNLOADED
+    
+    @property
+    def skipped(self):
+        return self.state == SKIPPED
+    
+    @property
+    def failed(self):
+        return self.state == FAILED_STATE
         
     @property
     def url(self):
-         return f"https://open.spotify.com/track/{id}"
+         return f"https://open.spotify.com/track/{self.id}"
     
     @property
     def filename(self):
-        return self.clean_filename(f"{self.name}.mp3")
+        if self._filename is None:
+            self._filename = self.clean_filename(f"{self.name}.mp3")
+        return self._filename
         
     @property
     def name(self): 
-        if self.in_album:
-            if self.track_number is not None:
-                if self.track_number<10:
-                    return f"0{self.track_number} - {self.title}"
+        if self._name is None:
+            if self.in_album:
+                if self.track_number is not None:
+                    if self.track_number<10:
+                        self._name = f"0{self.track_number} - {self.title}"
+                    else:
+                        self._name = f"{self.track_number} - {self.title}"
                 else:
-                    return f"{self.track_number} - {self.title}"
+                    self._name = self.title
             else:
-                return self.title
-        else:
-            return f"{self.artist} - {self.album} - {self.title}"
+                self._name = f"{self.artist} - {self.album} - {self.title}"
+        return self._name
         
     def clean_filename(self, fn):
-        validchars = "-_.() '',"
-        out = ""
-        for c in fn:
-          if str.isalpha(c) or str.isdigit(c) or (c in validchars):
-            out += c
-          else:
-            out += "-"
+        out = "".join(c if (c.isalpha() or c.isdigit() or c in VALID_FILENAME_CHARS) else "-" for c in fn)
         return unidecode(out)
 
 
-class SpotifyScraperThread(QThread):
+class Signal:
+    # minimal stand-in for pyqtSignal, so the scraper runs without Qt.
+    # slots are called directly from the emitting thread.
     
-    counts = pyqtSignal(int, int, int, int)
-    token_updated = pyqtSignal(str)
-    progress_updated = pyqtSignal(str)
+    def __init__(self):
+        self.slots = []
     
+    def connect(self, slot):
+        self.slots.append(slot)
     
-    def __init__(self, link, token, output_path):
-        super().__init__()
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+
+def retag_track_file(path, track, cover):
+    # runs in a retag worker process. (result, checksum of the whole file, None when
+    # it did not change), the sync state keeps the same checksum as after a download
+    from id3_tags import retag_file
+    result = retag_file(path, track, cover)
+    return result, None if result == "unchanged" else file_checksum(path)
+
+
+class SpotifyScraper:
+    
+    def __init__(self, link, token, output_path, max_workers=4, max_per_host=None, http_client=None, buffer_size=64*1024, cover_cache=None, token_ttl=300, token_provider=None, metadata_cache=None, use_sync_state=True, use_library=True, api_url=DOWNLOADER_URL, metrics=None,
+                 download_slots=None, priority=0, inflight=None, bandwidth=None, api_endpoints=None,
+                 token_pool=None, profile=False):
+        # signals: counts(track_count, downloaded, skipped, failed), token_updated(token), progress_updated(message),
+        # track_updated(track) whenever a track's phase, byte count or state changes
+        self.counts = Signal()
+        self.token_updated = Signal()
+        self.progress_updated = Signal()
+        self.track_updated = Signal()
         self.link = link
+        # the downloader api, another url points the scraper at a local mock (see benchmark.py).
+        # api_endpoints instead spreads calls over several urls, hedging slow ones, and can be shared.
+        self.api = api_endpoints or ApiEndpoints([api_url])
         self.tracks = []
-        self.token = token
+        # phase timings, byte and retry counts and http statuses, can be shared by several scrapers
+        self.metrics = metrics or RunMetrics()
+        # the provider keeps a browser warm across token refreshes and runs
+        self.token_provider = token_provider
+        # a token_pool (see token_manager.py) resolves links with several tokens at once and can be shared
+        self.tokens = token_pool or TokenManager(token, self.fetch_token, ttl=token_ttl, prefetch=self.prefetch_token)
         self.output_path = output_path
         # enable debug is debug is present in url
         self.debug = "debug" in link
+        # debug runs are profiled too, see profiler.py
+        self.profile = profile or self.debug
+        # the RunProfiler of a profiled run, while it runs
+        self.profiler = None
+        # concurrency
+        self.max_workers = max(1, max_workers)
+        # keep at least one pooled connection per worker for each host
+        self.http = http_client or HttpClient(pool_maxsize=max(10, self.max_workers), max_per_host=max_per_host)
+        # album tracks share a cover, fetch it once
+        self.cover_cache = cover_cache or CoverCache()
+        # /metadata and /trackList responses, None to always ask the api
+        self.metadata_cache = metadata_cache
+        # per folder record of downloaded tracks, opened once the output folder is known
+        self.use_sync_state = use_sync_state
+        self.sync_state = None
+        # library wide store under the output path, tracks already downloaded for
+        # another playlist or album are linked in instead of downloaded again
+        self.use_library = use_library
+        self.library = None
+        # track ids held by the library, loaded once per run
+        self.library_ids = set()
+        # watchlist syncs: download slots shared by all scrapers (handed out by priority),
+        # and the track ids being downloaded by any of them so each is fetched once
+        self.download_slots = download_slots
+        self.priority = priority
+        self.inflight = inflight
+        # caps on audio and cover transfer rates, shared by scrapers running at the same time
+        self.bandwidth = bandwidth or BandwidthLimiter()
+        self.throughput_reported_at = time.monotonic()
+        # chunk size used when streaming audio to disk
+        self.buffer_size = buffer_size
+        # the exception that ended the last run early, if any
+        self.run_error = None
+        # api responses fetched by metadata_fingerprint, used once instead of asking again
+        self.fresh_responses = {}
+        self.counts_lock = threading.Lock()
+        # tracks per state, kept up to date by set_track_state
+        self.state_counts = {QUEUED: 0, DOWNLOADED: 0, SKIPPED: 0, FAILED_STATE: 0}
+        self.claimed_filenames = set()
     
     def is_album(self, url):
         return "/album/" in url 
@@ -134,62 +252,80 @@ class SpotifyScraperThread(QThread):
         return len(self.tracks)
         
     def downloaded_track_count(self):
-        return len([track for track in self.tracks if track.downloaded])
+        return self.state_counts[DOWNLOADED]
     
     def skipped_track_count(self):
-        return len([track for track in self.tracks if track.skipped])
+        return self.state_counts[SKIPPED]
         
     def failed_track_count(self):
-        return len([track for track in self.tracks if track.failed])
+        return self.state_counts[FAILED_STATE]
+    
+    def reset_tracks(self):
+        with self.counts_lock:
+            self.tracks = []
+            self.state_counts = dict.fromkeys(self.state_counts, 0)
     
     def failed_tracks(self):
         return [track for track in self.tracks if track.failed]
     
     
-    def random_track_id(self):
-        return random.choice(self.tracks).id
+    @property
+    def token(self):
+        return self.tokens.token
         
            
-    async def _fetch_token(self):
+    def get_token_provider(self):
+        if self.token_provider is None:
+            self.token_provider = default_provider()
+        return self.token_provider
+    
+    def prefetch_token(self):
+        self.get_token_provider().prefetch()
+    
+    def fetch_token(self):
         self.progress_updated.emit("\tGetting new token")
         try:
-            self.token = await get_token()
-            if self.token:
-                self.token_updated.emit(self.token)
+            with self.metrics.timed("token"):
+                token = self.get_token_provider().get_token()
+            self.metrics.count("tokens_fetched", result="ok" if token else "empty")
+            if token:
+                self.token_updated.emit(token)
                 self.progress_updated.emit("\tToken fetched successfully!")
             else:
                 self.progress_updated.emit("\tFailed to fetch token")
+            return token
         except Exception as e:
             self.progress_updated.emit(f"\tFailed to fetch token: {str(e)}")
 
-    def get_token_if_needed(self):
-        if not self.token_is_valid():
-            asyncio.run(self._fetch_token())
-        
-    def token_is_valid(self):
-        if len(self.token)<10:
-            return False
-        else:
-            try:
-                resp = self._call_downloader_api(f"/download/{self.random_track_id()}?token={self.token}")
-                resp_json = resp.json()
-                return resp_json['success']
-            except Exception as e:
-                self.progress_updated.emit("error while checking token" + str(e))
-                self.progress_updated.emit(str(traceback.format_exc()))
-                return False
-
           
-    def run(self):
+    def run(self, retag=False):
+        # retag rewrites the id3 tags of the tracks already downloaded instead of downloading
+        if not self.profile:
+            return self.scrape(retag)
+        from profiler import RunProfiler
+        try:
+            with RunProfiler(self.output_path, log=self.progress_updated.emit) as self.profiler:
+                self.scrape(retag)
+        finally:
+            self.profiler = None
+    
+    
+    def profiled(self, fn):
+        # fn as submitted to a worker thread, profiled along with the run if it is profiled
+        return fn if self.profiler is None else self.profiler.wrap(fn)
+    
+    
+    def scrape(self, retag=False):
+        library_path = self.output_path
         try:
             album_cover = None
+            self.revalidate_cached_listing()
             # get item metadata
             if self.is_playlist(self.link) or self.is_album(self.link):
                 entity_id = self.link.split('/')[-1].split('?')[0]
 
                 if self.is_playlist(self.link):
-                    entity_metadata_resp = self._call_downloader_api(f"/metadata/playlist/{entity_id}")
-                    entity_metadata = entity_metadata_resp.json()
+                    entity_metadata = self._call_downloader_api_json(f"/metadata/playlist/{entity_id}")
                     entity_type = "playlist"
                     if isinstance(entity_metadata["artists"], (list, tuple)):
                         artist=', '.join(entity_metadata["artists"])
@@ -197,8 +333,7 @@ class SpotifyScraperThread(QThread):
                         artist=entity_metadata["artists"]
                     entity_name = entity_metadata['title'] + " (" + artist + ")"
                 else:
-                    entity_metadata_resp = self._call_downloader_api(f"/metadata/album/{entity_id}")
-                    entity_metadata = entity_metadata_resp.json()
+                    entity_metadata = self._call_downloader_api_json(f"/metadata/album/{entity_id}")
                     entity_type = "album"
                     if isinstance(entity_metadata["artists"], (list, tuple)):
                         artist=', '.join(entity_metadata["artists"])
@@ -210,182 +345,625 @@ class SpotifyScraperThread(QThread):
                     
                 self.progress_updated.emit(entity_type + ": " + entity_name)
                 if not entity_metadata["success"]:
-                    self.progress_updated.emit("not a valid "+ entity_name + ", Spotify api return error message: " + playlist_metadata["message"])
+                    self.progress_updated.emit("not a valid "+ entity_name + ", Spotify api return error message: " + entity_metadata["message"])
+                    self.run_error = RuntimeError(entity_metadata["message"])
                     return                
 
                 entity_name = entity_name.replace("/", "-")
                 self.output_path = Path(self.output_path + "/" + entity_name)
                 
-                self.progress_updated.emit("Getting tracks metadata")
-                self.get_tracks_to_download(entity_type, entity_id, album_cover=album_cover)
-                self.progress_updated.emit(f"\nDownloading {len(self.tracks)} tracks:")
+                self.reset_tracks()
+                tracks = self.iter_tracks_to_download(entity_type, entity_id, album_cover=album_cover)
+                self.progress_updated.emit("\nDownloading tracks:")
                 
             elif self.is_track(self.link):
                 self.output_path = Path(self.output_path)
                 self.progress_updated.emit("Single track")
                 entity_type = "track"
                 entity_id = self.link.split('/')[-1].split('?')[0]
-                track_resp = self._call_downloader_api( f"/metadata/track/{entity_id}").json()
+                track_resp = self._call_downloader_api_json(f"/metadata/track/{entity_id}")
                 self.tracks = [SpotifySong(track_resp)]
+                self.state_counts[QUEUED] += 1
+                self.track_updated.emit(self.tracks[0])
+                tracks = self.tracks
                 
             else:
                 self.progress_updated.emit("Error: Invalid url")
+                self.run_error = RuntimeError(f"invalid url: {self.link}")
                 return
         
+            if retag and not os.path.exists(self.output_path):
+                self.progress_updated.emit(f"Nothing to retag, {self.output_path} does not exist")
+                return
             if not os.path.exists(self.output_path):
                 os.makedirs(self.output_path)
+            if self.use_sync_state:
+                self.sync_state = SyncState(self.output_path)
+            if retag:
+                self.retag_all_tracks(tracks)
+                return
+            if self.use_library:
+                self.library = LibraryStore(library_path)
+                self.library_ids = self.library.ids()
             
-            self.download_all_tracks(entity_type)
+            self.download_all_tracks(entity_type, tracks)
+            self.progress_updated.emit(f"\nProcessed {len(self.tracks)} tracks")
             if entity_type == "track":
                 self.track_scrape_report()
             else:
                 self.playlist_scrape_report()
                 
         except Exception as e:
+            self.run_error = e
             self.progress_updated.emit("Error while downloading" + str(e))
             if self.debug:
                 self.progress_updated.emit(str(traceback.format_exc()))
+        finally:
+            if self.sync_state is not None:
+                self.sync_state.close()
+                self.sync_state = None
+            if self.library is not None:
+                self.library.close()
+                self.library = None
+    
+    
+    def entity(self):
+        # (entity type, entity id) of the link, entity type None for invalid urls
+        entity_id = self.link.split('/')[-1].split('?')[0]
+        for entity_type in ("playlist", "album", "track"):
+            if f"/{entity_type}/" in self.link:
+                return entity_type, entity_id
+        return None, entity_id
+    
+    
+    def metadata_fingerprint(self):
+        # digest of the live /metadata response and every /trackList page, to tell whether a
+        # playlist or album changed since the last sync (the api has no snapshot id or track
+        # count for it). The responses are kept for this run, so listing costs no extra calls,
+        # and replace cached ones. None if the api said no.
+        entity_type, entity_id = self.entity()
+        if entity_type is None:
+            return None
+        metadata_endpoint = f"/metadata/{entity_type}/{entity_id}"
+        list_endpoint = f"/trackList/{entity_type}/{entity_id}"
+        responses = {metadata_endpoint: self._call_downloader_api(metadata_endpoint).json()}
+        if not responses[metadata_endpoint].get("success"):
+            return None
+        if entity_type != "track":
+            endpoint = list_endpoint
+            while endpoint is not None:
+                page = responses[endpoint] = self._call_downloader_api(endpoint).json()
+                if not page.get("success", True):
+                    return None
+                next_offset = page.get("nextOffset") if page.get("trackList") else None
+                endpoint = f"{list_endpoint}?offset={next_offset}" if next_offset else None
+        # a cached listing could hide the change
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(metadata_endpoint)
+            self.metadata_cache.invalidate(list_endpoint)
+            for endpoint, data in responses.items():
+                self.metadata_cache.put(endpoint, data)
+        self.fresh_responses.update(responses)
+        return hashlib.sha1(json.dumps(responses, sort_keys=True).encode()).hexdigest()
+    
+    
+    def revalidate_cached_listing(self):
+        # a cached playlist or album listing is only used once checked against the api,
+        # so an edited playlist shows up at once. The check fetches the listing (see
+        # metadata_fingerprint) and this run uses it, nothing is asked twice.
+        entity_type, entity_id = self.entity()
+        if self.metadata_cache is None or self.fresh_responses or entity_type not in ("playlist", "album"):
+            return
+        if self.metadata_cache.get(f"/trackList/{entity_type}/{entity_id}") is None:
+            # nothing cached, the listing is fetched page by page while downloading
+            return
+        self.progress_updated.emit("checking the cached track list")
+        if self.metadata_fingerprint() is None:
+            # the api said no, its answer is reported instead of the cached listing
+            self.metadata_cache.invalidate(f"/metadata/{entity_type}/{entity_id}")
+            self.metadata_cache.invalidate(f"/trackList/{entity_type}/{entity_id}")
     
     
     def get_tracks_to_download(self, entity_type: str, entity_id: str, album_cover=None) -> list:
-        if entity_type in ["playlist", "album"]:
-            tracks_resp = self._call_downloader_api(f"/trackList/{entity_type}/{entity_id}").json()
-            track_number = 1
-            if tracks_resp.get('trackList'):
-                self.tracks = []
+        self.reset_tracks()
+        for track in self.iter_tracks_to_download(entity_type, entity_id, album_cover=album_cover):
+            pass
+        return self.tracks
+    
+    
+    def iter_tracks_to_download(self, entity_type: str, entity_id: str, album_cover=None):
+        # yields tracks page by page, the next page is already being fetched
+        # while the tracks of the current one are handed out
+        if entity_type not in ["playlist", "album"]:
+            return
+        endpoint = f"/trackList/{entity_type}/{entity_id}"
+        track_number = 1
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            tracks_resp = self._call_downloader_api_json(endpoint)
+            while tracks_resp.get('trackList'):
+                next_page = None
+                if next_offset := tracks_resp.get('nextOffset'):
+                    next_page = prefetcher.submit(self.profiled(self._call_downloader_api_json), f"{endpoint}?offset={next_offset}")
                 for track_resp in tracks_resp['trackList']:
-                    self.add_track(track_resp, album_cover, track_number, entity_type)
+                    yield self.add_track(track_resp, album_cover, track_number, entity_type)
                     track_number += 1
-
-                while next_offset := tracks_resp.get('nextOffset'):
-                    tracks_resp = self._call_downloader_api(f"/trackList/{entity_type}/{entity_id}?offset={next_offset}").json()
-                    for data in tracks_resp['trackList']:
-                        self.add_track(track_resp, album_cover, track_number, entity_type)
-                        track_number += 1
+                if next_page is None:
+                    break
+                tracks_resp = next_page.result()
+    
                             
     def add_track(self, track_resp, album_cover, track_number, entity_type):
-        track = SpotifySong(track_resp)
-        if entity_type=="playlist":
-            track.track_number = track_number
-        if album_cover is not None:
-            track.cover = album_cover
-        if entity_type == "album":
-            track.in_album = True
+        # playlists number tracks by position, albums keep the album's track numbers
+        track = SpotifySong(track_resp, album_cover=album_cover,
+            track_number=track_number if entity_type=="playlist" else None,
+            in_album=entity_type == "album")
+        with self.counts_lock:
+            self.state_counts[QUEUED] += 1
         self.tracks.append(track)
+        self.track_updated.emit(track)
+        return track
         
     
-    def download_all_tracks(self, entity_type:str):
+    def download_all_tracks(self, entity_type:str, tracks=None):
+        # tracks can be a generator, downloads start while later pages are still listed
+        if tracks is None:
+            tracks = self.tracks
+        self.claimed_filenames = set()
+        with self.metrics.timed("download_all_tracks"):
+            if self.max_workers == 1:
+                for track in tracks:
+                    self.process_track(track, entity_type)
+                return
+            process_track = self.profiled(self.process_track)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(process_track, track, entity_type) for track in tracks]
+                for future in as_completed(futures):
+                    future.result()
+    
+    
+    def process_track(self, track:SpotifySong, entity_type:str):
+        track.started_at = time.monotonic()
+        try:
+            with self.counts_lock:
+                # the same file can show up twice in a playlist, only one worker gets it
+                already_claimed = track.filename in self.claimed_filenames
+                self.claimed_filenames.add(track.filename)
+            if already_claimed or self.is_synced(track):
+                self.set_track_state(track, SKIPPED)
+                track.phase = "skipped"
+                self.progress_updated.emit(f"file exists, skipping: {track.name}")
+                if not already_claimed and self.library is not None and track.id not in self.library_ids:
+                    # downloaded before the library existed
+                    self.add_to_library(track)
+            elif self.link_from_library(track):
+                self.set_track_state(track, DOWNLOADED)
+            elif not self.claim_download(track):
+                # another scraper sharing the library just downloaded it
+                if self.link_from_library(track, check_ids=False):
+                    self.set_track_state(track, DOWNLOADED)
+                else:
+                    self.download_with_retries(track, entity_type)
+            else:
+                try:
+                    self.download_with_retries(track, entity_type)
+                finally:
+                    if self.inflight is not None:
+                        self.inflight.release(track.id)
+        except Exception as exc:
+            self.track_progress(track, f"error while processing track: {str(exc)}")
+            self.set_track_state(track, FAILED_STATE)
+            track.phase = "failed"
+            if self.sync_state is not None:
+                self.sync_state.set(track.id, track.filename, FAILED)
+            if self.debug:
+                self.progress_updated.emit(str(traceback.format_exc()))
+        
+        track.finished_at = time.monotonic()
+        self.metrics.observe("track", track.finished_at - track.started_at, track.failed)
+        self.metrics.count("tracks", state=track.state)
+        self.track_updated.emit(track)
+        with self.counts_lock:
+            self.counts.emit(self.track_count(), self.downloaded_track_count(), self.skipped_track_count(), self.failed_track_count())
+    
+    
+    def retag_all_tracks(self, tracks, processes=None):
+        # tags are rendered and written by a pool of processes. Covers are fetched
+        # through the cover cache by max_workers threads, each track is handed to
+        # the processes as soon as its cover is there.
+        cover_futures = {}
+        futures = {}
+        retag_cover = self.profiled(self.retag_cover)
+        with ProcessPoolExecutor(max_workers=processes) as executor, ThreadPoolExecutor(max_workers=self.max_workers) as cover_fetcher:
+            for track in tracks:
+                track.started_at = time.monotonic()
+                filename = self.track_file(track)
+                if filename is None:
+                    track.error = "not in the folder"
+                    self.finish_retag(track, SKIPPED, "not in the folder")
+                    continue
+                cover_futures[cover_fetcher.submit(retag_cover, track)] = (track, filename)
+            for cover_future in as_completed(cover_futures):
+                track, filename = cover_futures[cover_future]
+                try:
+                    cover = cover_future.result()
+                except Exception as exc:
+                    # without the cover the retag would drop the picture from the tag
+                    track.error = f"cover: {str(exc)}"
+                    self.finish_retag(track, FAILED_STATE, track.error)
+                    continue
+                futures[executor.submit(retag_track_file, str(filename), track, cover)] = track
+            for future in as_completed(futures):
+                track = futures[future]
+                try:
+                    result, checksum = future.result()
+                except Exception as exc:
+                    track.error = str(exc)
+                    self.finish_retag(track, FAILED_STATE, f"error while retagging: {str(exc)}")
+                    continue
+                self.metrics.count("retagged", result=result)
+                if self.sync_state is not None:
+                    filename = self.output_path / track.filename
+                    if checksum is None:
+                        record = self.sync_state.get(track.id)
+                        checksum = record.checksum if record is not None else None
+                    self.sync_state.set(track.id, track.filename, DONE, os.path.getsize(filename), checksum)
+                self.finish_retag(track, SKIPPED if result == "unchanged" else DOWNLOADED, f"tags {result}")
+        
+        retagged = self.downloaded_track_count()
+        self.progress_updated.emit(f"\nRetagged {retagged} of {len(self.tracks)} tracks, {self.skipped_track_count()} unchanged or missing, {self.failed_track_count()} failed")
         for track in self.tracks:
-            full_filename = self.output_path / track.filename
+            if track.error is not None:
+                self.progress_updated.emit(f"{track.name}: {track.error}")
+    
+    
+    def retag_cover(self, track):
+        if not track.cover:
+            return None
+        with self.metrics.timed("cover"):
+            return self.cover_cache.get(track.cover, self.fetch_cover)
+    
+    
+    def finish_retag(self, track, state, message):
+        self.set_track_state(track, state)
+        track.finished_at = time.monotonic()
+        self.track_progress(track, message)
+        with self.counts_lock:
+            self.counts.emit(self.track_count(), self.downloaded_track_count(), self.skipped_track_count(), self.failed_track_count())
+    
+    
+    def track_file(self, track):
+        # where the track's file is, under its current name if the naming changed since it was downloaded
+        filename = self.output_path / track.filename
+        record = self.sync_state.get(track.id) if self.sync_state is not None else None
+        if record is not None and record.filename != track.filename and not os.path.exists(filename):
+            recorded_filename = self.output_path / record.filename
+            if os.path.exists(recorded_filename):
+                os.replace(recorded_filename, filename)
+                self.progress_updated.emit(f"renamed {record.filename} to {track.filename}")
+                self.sync_state.set(track.id, track.filename, DONE, record.size, record.checksum)
+        if os.path.exists(filename) and os.path.getsize(filename) != 0:
+            return filename
+        return None
+    
+    
+    def download_with_retries(self, track, entity_type):
+        self.progress_updated.emit(f"{track.name}")
+        if self.sync_state is not None:
+            self.sync_state.set(track.id, track.filename, DOWNLOADING)
+        retries = 0
+        max_retries = 3
+        while not track.downloaded:
             try:
-                if os.path.exists(full_filename) and os.path.getsize(full_filename) != 0:
-                    track.skipped=True
-                    self.progress_updated.emit(f"file exists, skipping: {track.name}")
-                else:
-                    self.progress_updated.emit(f"{track.name}")
-                    retries = 0
-                    max_retries = 3
-                    while not track.downloaded:
-                        try:
-                            self.get_token_if_needed()
-                            self.get_track_link(track)
-                            self.download_track(track, entity_type)
-                            self.progress_updated.emit('\tdone')
-                        except Exception as exc:
-                            self.progress_updated.emit(f"\terror while processing track: {str(exc)}")
-                            if self.debug:
-                                self.progress_updated.emit(str(traceback.format_exc()))
-                            retries += 1
-                            self.progress_updated.emit(f'\tretrying... attempt {retries} of {max_retries}')
-                            sleep(retries)
-                            if retries>max_retries:
-                                raise exc
+                # the slot is given back while waiting for the next attempt
+                with self.download_slot():
+                    self.get_track_link(track)
+                    self.download_track(track, entity_type)
+                self.track_progress(track, 'done')
             except Exception as exc:
-                self.progress_updated.emit(f"\terror while processing track: {str(exc)}")
-                track.failed=True
+                self.track_progress(track, f"error while processing track: {str(exc)}")
                 if self.debug:
                     self.progress_updated.emit(str(traceback.format_exc()))
-                 
-            self.counts.emit(self.track_count(), self.downloaded_track_count(), self.skipped_track_count(), self.failed_track_count())
+                retries += 1
+                if retries>max_retries:
+                    raise exc
+                self.metrics.count("retries", error=type(exc).__name__)
+                self.track_progress(track, f'retrying... attempt {retries} of {max_retries}')
+                sleep(backoff_delay(retries))
+    
+    
+    def download_slot(self):
+        if self.download_slots is None:
+            return nullcontext()
+        return self.download_slots.slot(self.priority)
+    
+    
+    def claim_download(self, track):
+        # False if another scraper writing to the same library is or was downloading
+        # the track in this sync cycle, in which case this waits for it to finish
+        if self.inflight is None or self.library is None:
+            return True
+        done = self.inflight.claim(track.id)
+        if done is None:
+            return True
+        if not done.is_set():
+            self.track_progress(track, "waiting for another download of this track")
+            done.wait()
+        return False
+    
+    
+    def set_track_state(self, track, state):
+        with self.counts_lock:
+            self.state_counts[track.state] -= 1
+            self.state_counts[state] += 1
+            track.state = state
+    
+    
+    def is_synced(self, track):
+        full_filename = self.output_path / track.filename
+        record = self.sync_state.get(track.id) if self.sync_state is not None else None
+        if record is not None and record.status == DONE and record.filename != track.filename:
+            # the track got a new name (e.g. renumbered in the playlist), move the file instead of downloading it again
+            recorded_filename = self.output_path / record.filename
+            if os.path.exists(recorded_filename) and not os.path.exists(full_filename):
+                os.replace(recorded_filename, full_filename)
+                self.progress_updated.emit(f"renamed {record.filename} to {track.filename}")
+                self.sync_state.set(track.id, track.filename, DONE, record.size, record.checksum)
+                return True
+            # the new name is taken by another track's old file, download it again
+            return False
+        if os.path.exists(full_filename) and os.path.getsize(full_filename) != 0:
+            if self.sync_state is not None and (record is None or record.status != DONE):
+                # file from before the sync state existed
+                self.sync_state.set(track.id, track.filename, DONE, os.path.getsize(full_filename))
+            return True
+        return False
+    
+    
+    def link_from_library(self, track, check_ids=True):
+        # the track was downloaded for another playlist or album, link it in.
+        # check_ids False also finds tracks added to the library since this run started.
+        if self.library is None or (check_ids and track.id not in self.library_ids):
+            return False
+        filename = self.output_path / track.filename
+        try:
+            with self.metrics.timed("library"):
+                method = self.library.materialize(track.id, filename)
+                retagged, checksum = "unchanged", None
+                if method is not None:
+                    # the stored file is tagged for the folder that downloaded it (track number,
+                    # album). When this folder's tag differs the link is broken by writing the
+                    # new tag and a copy of the audio, other folders keep theirs.
+                    retagged, checksum = retag_track_file(filename, track, self.track_cover(track))
+        except OSError as exc:
+            self.track_progress(track, f"could not take track from the library: {str(exc)}")
+            return False
+        if method is None:
+            self.library_ids.discard(track.id)
+            return False
+        self.library_ids.add(track.id)
+        self.metrics.count("library_links", method=method)
+        if retagged != "unchanged":
+            self.metrics.count("library_retags")
+            method = f"{method} and retagged"
+        self.track_progress(track, f"{method} from library")
+        if self.sync_state is not None:
+            self.sync_state.set(track.id, track.filename, DONE, os.path.getsize(filename), checksum)
+        return True
+    
+    
+    def add_to_library(self, track, size=None, checksum=None):
+        try:
+            self.library.add(track.id, self.output_path / track.filename, size, checksum)
+            self.library_ids.add(track.id)
+        except (OSError, sqlite3.Error) as exc:
+            # the download itself is fine, it just won't be shared
+            self.progress_updated.emit(f"\tcould not add {track.name} to the library: {str(exc)}")
+    
+    
+    def track_progress(self, track, message):
+        track.phase = message
+        self.track_updated.emit(track)
+        # with several tracks in flight, tell which track a status line belongs to
+        if self.max_workers == 1:
+            self.progress_updated.emit(f"\t{message}")
+        else:
+            self.progress_updated.emit(f"\t{track.name}: {message}")
     
     
     def get_track_link(self, track):
-        self.progress_updated.emit(f"\tget track link")
-        resp = self._call_downloader_api(f"/download/{track.id}?token={self.token}")    
-        resp_json = resp.json() 
-        if not resp_json['success']:
-            self.progress_updated.emit("Could not get track link for "+track.name)
-            self.progress_updated.emit(resp_json)
-            track.failed = True
-            if resp_json["statusCode"]==403:
-                self.token_error.emit()
+        self.track_progress(track, "get track link")
+        with self.tokens.lease() as token:
+            with self.metrics.timed("track_link"):
+                resp = self._call_downloader_api(f"/download/{track.id}?token={token}")
+                resp_json = resp.json() 
+            if not resp_json['success']:
+                self.metrics.count("track_link_errors", status=str(resp_json.get("statusCode")))
+                self.progress_updated.emit("Could not get track link for "+track.name)
+                self.progress_updated.emit(str(resp_json))
                 track.error = resp_json["message"]
+                if resp_json["statusCode"]==403:
+                    # the token was rejected, the next caller fetches a new one
+                    self.tokens.invalidate(token)
+                    raise TokenError(track.error)
             else:
-                track.error = resp_json["message"]
-        else:
-            track.link = resp_json["link"]
+                track.link = resp_json["link"]
     
         
     def download_track(self, track:SpotifySong, entity_type:str):
-        self.progress_updated.emit(f"\tdownload audio")
+        # eyed3 is only needed once something gets downloaded
+        from id3_tags import render_tag, strip_id3v2
+        
+        self.track_progress(track, "download audio")
         if track.link is None:
             raise RuntimeError(f"no download link for '{track.name}")
         
-        filename = self.output_path/f"{track.filename}"
-
-        hdrs = {
-            #'Host': 'cdn[#].tik.live', # <-- set this below
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip',
-            'Referer': 'https://spotifydown.com/',
-            'Origin': 'https://spotifydown.com',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'cross-site',
-            'Sec-GPC': '1'
-        }
-        hdrs['Host'] = track.link.split('/')[2]
-        audio_dl_resp = requests.get(track.link, headers=hdrs)
-        if not audio_dl_resp.ok:
-            error = f"Bad download response for track '{track.title}' ({track.id}): {audio_dl_resp.status_code}: {audio_dl_resp.content}"
-            raise RuntimeError(error)
+        # tags are built in memory and written ahead of the audio in a single pass
+        self.track_progress(track, "adding tags")
+        cover = self.track_cover(track)
+        with self.metrics.timed("tag"):
+            tag_data = render_tag(track, cover)
         
-        self.progress_updated.emit(f"\tsaving file")
-        with open(filename, 'wb') as track_mp3_fp:
-            track_mp3_fp.write(audio_dl_resp.content)
-
-        if not os.path.exists(filename):
-              raise Exception("download failed")          
-        if os.path.getsize(filename) == 0:
-              raise Exception("downloaded failed. File is zero byte.")
-              os.remove(filename) 
+        filename = self.output_path/f"{track.filename}"
+        # the download lands in a hidden part file and is only renamed once complete.
+        # the resume file next to it records how to continue an interrupted download.
+        part_filename = self.output_path/f".{track.filename}.part"
+        resume_filename = self.output_path/f".{track.filename}.part.json"
+        resume = self.load_resume_state(part_filename, resume_filename, tag_data)
+        headers = AUDIO_HEADERS
+        if resume is not None:
+            headers = dict(AUDIO_HEADERS, Range=f"bytes={resume['offset']}-")
+            if resume['etag']:
+                # the server sends the whole file instead if it changed
+                headers['If-Range'] = resume['etag']
         
-        # tags
-        self.progress_updated.emit(f"\tadding tags")
-        mp3_file = eyed3.load(filename)
-        if (mp3_file.tag == None):
-            mp3_file.initTag()
-        mp3_file.tag.album = track.album
-        mp3_file.tag.artist = track.artist
-        mp3_file.tag.title = track.title
-        mp3_file.tag.recording_date = track.releaseDate
-        mp3_file.tag.track_num = track.track_number
-          
-        # cover art
-        if cover_art_url := track.cover:
-            hdrs['Host'] = cover_art_url.split('/')[2]
-            cover_resp = requests.get(cover_art_url,headers=hdrs)
-            mp3_file.tag.images.set(ImageFrame.FRONT_COVER, cover_resp.content, 'image/jpeg')
-        # save tags
-        mp3_file.tag.save(version=ID3_V2_3)
+        keep_partial = False
+        audio_size = resumed_size = 0
+        audio_start = time.perf_counter()
+        try:
+            with self.http.stream(track.link, headers=headers) as audio_dl_resp:
+                self.metrics.status("audio", audio_dl_resp.status_code)
+                if not audio_dl_resp.ok:
+                    error = f"Bad download response for track '{track.title}' ({track.id}): {audio_dl_resp.status_code}: {audio_dl_resp.content}"
+                    raise RuntimeError(error)
+                
+                self.track_progress(track, "saving file")
+                chunks = audio_dl_resp.iter_content(chunk_size=self.buffer_size)
+                if resume is not None and self.is_valid_resume(audio_dl_resp, resume):
+                    self.track_progress(track, f"resuming at byte {resume['offset']}")
+                    checksum = hashlib.sha1()
+                    with open(part_filename, 'rb') as track_mp3_fp:
+                        while data := track_mp3_fp.read(self.buffer_size):
+                            checksum.update(data)
+                    audio_size = resumed_size = resume['audio_size']
+                    mode = 'ab'
+                    keep_partial = True
+                else:
+                    if audio_dl_resp.status_code == 206:
+                        raise RuntimeError(f"Partial download response for track '{track.title}' ({track.id}) does not match the part file")
+                    if resume is not None:
+                        self.track_progress(track, "cannot resume, downloading from the start")
+                    content_length = int(audio_dl_resp.headers.get('Content-Length', 0)) or None
+                    resume = {
+                        'etag': audio_dl_resp.headers.get('ETag'),
+                        'content_length': content_length,
+                        'tag_checksum': hashlib.sha1(tag_data).hexdigest(),
+                        'tag_size': len(tag_data),
+                        'skipped': 0,
+                    }
+                    resumable = content_length is not None and audio_dl_resp.headers.get('Accept-Ranges') == 'bytes'
+                    def on_skip(skipped):
+                        # the cdn file may carry its own id3 tag, ours replaces it
+                        nonlocal keep_partial
+                        resume['skipped'] = skipped
+                        if resumable:
+                            with open(resume_filename, 'w') as resume_fp:
+                                json.dump(resume, resume_fp)
+                            keep_partial = True
+                    chunks = strip_id3v2(chunks, on_skip)
+                    checksum = hashlib.sha1(tag_data)
+                    audio_size = 0
+                    mode = 'wb'
+                
+                audio_host = host_of(track.link)
+                with open(part_filename, mode) as track_mp3_fp:
+                    if mode == 'wb':
+                        track_mp3_fp.write(tag_data)
+                    for chunk in chunks:
+                        self.bandwidth.consume(audio_host, len(chunk))
+                        self.report_throughput()
+                        track_mp3_fp.write(chunk)
+                        checksum.update(chunk)
+                        audio_size += len(chunk)
+                        track.bytes_downloaded = audio_size
+                        self.track_updated.emit(track)
+            
+            if audio_size == 0:
+                raise Exception("downloaded failed. File is zero byte.")
+            if resume['content_length'] is not None and resume['skipped'] + audio_size != resume['content_length']:
+                raise RuntimeError(f"download incomplete, got {resume['skipped'] + audio_size} of {resume['content_length']} bytes")
+            os.replace(part_filename, filename)
+            keep_partial = False
+        except BaseException:
+            self.metrics.observe("audio", time.perf_counter() - audio_start, error=True)
+            raise
+        finally:
+            # only what came over the network
+            self.metrics.count("audio_bytes", audio_size - resumed_size)
+            if not keep_partial:
+                for path in (part_filename, resume_filename):
+                    if os.path.exists(path):
+                        os.remove(path)
         
+        self.metrics.observe("audio", time.perf_counter() - audio_start)
         # update track state
-        track.downloaded=True
-        track.failed=False
+        self.set_track_state(track, DOWNLOADED)
+        if self.sync_state is not None:
+            self.sync_state.set(track.id, track.filename, DONE, len(tag_data) + audio_size, checksum.hexdigest())
+        if self.library is not None:
+            self.add_to_library(track, len(tag_data) + audio_size, checksum.hexdigest())
+    
+    
+    def report_throughput(self):
+        # every few seconds while audio is coming in
+        now = time.monotonic()
+        with self.counts_lock:
+            if now - self.throughput_reported_at < THROUGHPUT_REPORT_INTERVAL:
+                return
+            self.throughput_reported_at = now
+        self.progress_updated.emit(f"\tthroughput {format_rate(self.bandwidth.take_throughput())} ({self.bandwidth.describe()})")
+    
+    
+    def load_resume_state(self, part_filename, resume_filename, tag_data):
+        # what is needed to continue a download left by an earlier attempt, None to start over
+        try:
+            with open(resume_filename) as resume_fp:
+                resume = json.load(resume_fp)
+            part_size = os.path.getsize(part_filename)
+        except (OSError, ValueError):
+            return None
+        # the part file starts with the tag, it has to be the one we would write now
+        if resume.get('tag_checksum') != hashlib.sha1(tag_data).hexdigest() or part_size <= resume['tag_size']:
+            return None
+        resume['audio_size'] = part_size - resume['tag_size']
+        resume['offset'] = resume['skipped'] + resume['audio_size']
+        if resume['offset'] >= resume['content_length']:
+            return None
+        return resume
+    
+    
+    def is_valid_resume(self, resp, resume):
+        # a 206 has to continue exactly where the part file stops, in the same file
+        if resp.status_code != 206:
+            return False
+        if resume['etag'] and resp.headers.get('ETag') not in (None, resume['etag']):
+            return False
+        match = re.match(r"bytes (\d+)-\d+/(\d+)", resp.headers.get('Content-Range', ''))
+        return match is not None and int(match.group(1)) == resume['offset'] and int(match.group(2)) == resume['content_length']
+        
+    
+    def track_cover(self, track):
+        # cover art for the tag, None if there is none. A cover that can't be fetched
+        # is left out of the tag rather than failing (and retrying) the whole track,
+        # the cache does not keep the failure so the next track asks again.
+        if not track.cover:
+            return None
+        try:
+            with self.metrics.timed("cover"):
+                return self.cover_cache.get(track.cover, self.fetch_cover)
+        except Exception as exc:
+            self.metrics.count("cover_errors")
+            self.track_progress(track, f"no cover art, tagging without it: {str(exc)}")
+            return None
+    
+    
+    def fetch_cover(self, url):
+        cover_resp = self.http.get(url)
+        self.bandwidth.consume(host_of(url), len(cover_resp.content))
+        self.metrics.status("cover", cover_resp.status_code)
+        self.metrics.count("cover_bytes", len(cover_resp.content))
+        if not cover_resp.ok:
+            raise RuntimeError(f"Bad cover response: {cover_resp.status_code}")
+        return cover_resp.content
         
     
     def playlist_scrape_report(self):
@@ -398,15 +976,13 @@ class SpotifyScraperThread(QThread):
                 details += "\n" + track.name +   ((": "+ track.error) if track.error!=None else "")
             details += "\n"
         
-        directory_files = os.listdir(self.output_path)
+        directory_files = set(os.listdir(self.output_path))
         in_folder_not_in_playlist = []
-        playlist_filenames = []
-        for track in self.tracks:
-            playlist_filenames.append(track.filename)
+        playlist_filenames = {track.filename for track in self.tracks}
         
         # extraneous tracks
-        for filename in directory_files:
-            if filename not in playlist_filenames and filename != ".DS_Store" and not filename.startswith(".syncthing.") and not filename.endswith(".stem.m4a"):
+        for filename in sorted(directory_files):
+            if filename not in playlist_filenames and filename != ".DS_Store" and not filename.startswith(".syncthing.") and not filename.endswith(".stem.m4a") and not filename.endswith((".part", ".part.json", ".corrupt")) and not filename.startswith(SYNC_STATE_FILENAME):
                 in_folder_not_in_playlist.append(filename)
         if len(in_folder_not_in_playlist):
             details += "\nTracks in folder but not in playlist:"
@@ -414,11 +990,11 @@ class SpotifyScraperThread(QThread):
                 details += "\n" + track
             details += "\n"
         
-        # missing tracks
+        # missing tracks, noting the ones the library holds
         in_playlist_not_in_folder = []
         for track in self.tracks:
             if track.filename not in directory_files:
-                 in_playlist_not_in_folder.append(track.name)
+                 in_playlist_not_in_folder.append(track.name + (" (in library)" if track.id in self.library_ids else ""))
         if len(in_playlist_not_in_folder)>0:
             details += "\nTracks in playlist but not in folder:"
             for track in in_playlist_not_in_folder:
@@ -437,7 +1013,7 @@ class SpotifyScraperThread(QThread):
         if self.failed_track_count()>0:
             details += "\nFailed track download:"
             for track in self.failed_tracks():
-                details += "\n" + track
+                details += "\n" + track.name +   ((": "+ track.error) if track.error!=None else "")
             details += "\n"
         else:
             details += "Download completed sucessfully!"
@@ -445,29 +1021,31 @@ class SpotifyScraperThread(QThread):
         self.progress_updated.emit(details)
     
 
+    def _call_downloader_api_json(self, endpoint: str) -> dict:
+        data = self.fresh_responses.pop(endpoint, None)
+        if data is not None:
+            return data
+        if self.metadata_cache is not None:
+            data = self.metadata_cache.get(endpoint)
+            if data is not None:
+                return data
+        data = self._call_downloader_api(endpoint).json()
+        # error responses are not cached
+        if self.metadata_cache is not None and data.get('success', True):
+            self.metadata_cache.put(endpoint, data)
+        return data
+    
+    
     def _call_downloader_api(self, endpoint: str, **kwargs) -> requests.Response:
-        DOWNLOADER_URL = "https://api.spotifydown.com"
-        # Clean browser heads for API
-        DOWNLOADER_HEADERS = {
-            'Host': 'api.spotifydown.com',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
-            'Accept': '*/*',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip',
-            'Referer': 'https://spotifydown.com/',
-            'Origin': 'https://spotifydown.com',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Sec-Fetch-Dest': 'empty',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Site': 'same-site',
-            'Sec-GPC': '1',
-            'TE': 'trailers'
-        }
+        # /download/{id}?token=... is counted as download
+        name = endpoint.split("/")[1].split("?")[0]
         try:
-            resp = requests.get(DOWNLOADER_URL + endpoint, headers=DOWNLOADER_HEADERS,**kwargs)
+            with self.metrics.timed(f"api_{name}"):
+                resp = self.api.get(self.http, endpoint, API_HEADERS, metrics=self.metrics, **kwargs)
         except Exception as exc:
+            self.metrics.status(name, None)
             raise RuntimeError("ERROR: ", exc)
+        self.metrics.status(name, resp.status_code)
         return resp
 
 
@@ -0,0 +1,68 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+SYNC_STATE_FILENAME = ".spotifydownloader.sqlite3"
+
+DOWNLOADING = "downloading"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class TrackState:
+    id: str
+    filename: str
+    size: int
+    checksum: str
+    status: str
+    updated_at: float
+
+
+def file_checksum(path, buffer_size=1024*1024):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while chunk := fp.read(buffer_size):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class SyncState:
+    # per output folder record of the tracks in it, keyed by spotify track id,
+    # so renamed tracks can be moved in place and crashed runs resumed
+
+    def __init__(self, folder):
+        self.path = folder / SYNC_STATE_FILENAME
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS tracks (
+                id TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER,
+                checksum TEXT,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL)""")
+
+    def get(self, track_id):
+        with self.lock:
+            row = self.db.execute("SELECT id, filename, size, checksum, status, updated_at FROM tracks WHERE id = ?", (track_id,)).fetchone()
+        return TrackState(*row) if row else None
+
+    def all(self):
+        with self.lock:
+            rows = self.db.execute("SELECT id, filename, size, checksum, status, updated_at FROM tracks").fetchall()
+        return [TrackState(*row) for row in rows]
+
+    def set(self, track_id, filename, status, size=None, checksum=None):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO tracks (id, filename, size, checksum, status, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (track_id, filename, size, checksum, status, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
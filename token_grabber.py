@@ -1,29 +1,178 @@
 # copied from https://github.com/afkarxyz/SpotifyDown-GUI
 
 import asyncio
-import zendriver as zd
-
-async def wait_for_turnstile_token(page):
-    max_attempts = 20
-    attempts = 0
-    
-    while attempts < max_attempts:
-        element = await page.query_selector('input[name="cf-turnstile-response"]')
-        
-        if element:
-            attrs = element.attrs
-            if attrs and 'value' in attrs:
-                return attrs['value']
-        
-        await asyncio.sleep(0.5)
-        attempts += 1
-    
-    raise TimeoutError("Turnstile element not found within timeout period")
+import json
+import threading
+import time
+
+SPOTIFYDOWN_URL = "https://spotifydown.com/"
+
+# Resolves with the turnstile token as soon as the page fills it in.
+# Turnstile writes the hidden input from a postMessage sent by its iframe,
+# so both DOM mutations and window messages trigger a check. The token handed
+# out last time is ignored, it may still be in the page if it was not reloaded yet.
+TURNSTILE_WAIT_JS = """
+new Promise((resolve, reject) => {
+    const previous = %s;
+    const current = () => {
+        const element = document.querySelector('input[name="cf-turnstile-response"]');
+        return element && element.value && element.value !== previous ? element.value : null;
+    };
+    const found = current();
+    if (found) {
+        resolve(found);
+        return;
+    }
+    let timer = null;
+    const check = () => {
+        const value = current();
+        if (value) {
+            observer.disconnect();
+            window.removeEventListener('message', onMessage);
+            clearTimeout(timer);
+            resolve(value);
+        }
+    };
+    const onMessage = () => setTimeout(check, 0);
+    const observer = new MutationObserver(check);
+    observer.observe(document, {subtree: true, childList: true, attributes: true, attributeFilter: ['value']});
+    window.addEventListener('message', onMessage);
+    timer = setTimeout(() => {
+        observer.disconnect();
+        window.removeEventListener('message', onMessage);
+        reject(new Error('timeout'));
+    }, %d);
+})
+"""
+
+
+async def wait_for_turnstile_token(page, timeout=10, previous=None):
+    try:
+        return await page.evaluate(TURNSTILE_WAIT_JS % (json.dumps(previous), int(timeout * 1000)), await_promise=True)
+    except Exception as exc:
+        raise TimeoutError("Turnstile element not found within timeout period") from exc
+
+
+async def reload_page(page, timeout=10):
+    # Page.reload returns before the new document is there, wait for its load event.
+    # The handler is added first, zendriver enables the page domain when reload is sent.
+    from zendriver import cdp
+    loaded = asyncio.Event()
+    def on_load(event):
+        loaded.set()
+    page.add_handler(cdp.page.LoadEventFired, on_load)
+    try:
+        await page.reload()
+        await asyncio.wait_for(loaded.wait(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError("page did not reload within timeout period") from None
+    finally:
+        page.remove_handlers(cdp.page.LoadEventFired, on_load)
+
+
+class TokenProvider:
+    # keeps a browser warm between token refreshes. The browser lives on its own
+    # event loop thread, so callers from any thread share it, and the next token
+    # can be fetched in the background while the current one is still in use.
+
+    def __init__(self, headless=False, timeout=10, max_prefetch_age=240):
+        self.headless = headless
+        self.timeout = timeout
+        # turnstile tokens expire, a prefetched one older than this is thrown away
+        self.max_prefetch_age = max_prefetch_age
+        self.browser = None
+        self.page = None
+        self.prefetched = None
+        self.prefetched_at = 0
+        # a reloaded page can still show the token handed out before, it is never returned twice
+        self.last_token = None
+        self.lock = threading.Lock()
+        # a prefetch and a foreground fetch share the page, one at a time
+        self.fetch_lock = asyncio.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="token-provider", daemon=True)
+        self.thread.start()
+
+    async def _fetch(self):
+        async with self.fetch_lock:
+            try:
+                import zendriver as zd
+                if self.browser is None or self.browser.stopped:
+                    self.browser = await zd.start(headless=self.headless)
+                    self.page = None
+                if self.page is None:
+                    self.page = await self.browser.get(SPOTIFYDOWN_URL)
+                else:
+                    # a turnstile token can only be used once, reloading renders a new one
+                    await reload_page(self.page, self.timeout)
+                token = await wait_for_turnstile_token(self.page, self.timeout, self.last_token)
+                self.last_token = token
+                return token
+            except Exception:
+                # start from a fresh browser next time
+                await self._stop_browser()
+                raise
+
+    async def _stop_browser(self):
+        browser, self.browser, self.page = self.browser, None, None
+        if browser is not None:
+            try:
+                await browser.stop()
+            except Exception:
+                pass
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def get_token(self):
+        with self.lock:
+            future, self.prefetched = self.prefetched, None
+            if future is None or time.monotonic() - self.prefetched_at > self.max_prefetch_age:
+                if future is not None:
+                    future.cancel()
+                future = self._submit(self._fetch())
+        try:
+            return future.result(timeout=self.timeout * 3)
+        except Exception:
+            if future.done() and not future.cancelled():
+                # the fetch failed (a stale prefetch or a browser hiccup), try once more
+                return self._submit(self._fetch()).result(timeout=self.timeout * 3)
+            raise
+
+    def prefetch(self):
+        # start fetching the next token, picked up by the next get_token call
+        with self.lock:
+            if self.prefetched is None:
+                self.prefetched = self._submit(self._fetch())
+                self.prefetched_at = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.prefetched is not None:
+                self.prefetched.cancel()
+                self.prefetched = None
+        self._submit(self._stop_browser()).result(timeout=self.timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_default_provider = None
+_default_provider_lock = threading.Lock()
+
+
+def default_provider():
+    # one warm browser shared by every scrape in this process
+    global _default_provider
+    with _default_provider_lock:
+        if _default_provider is None:
+            _default_provider = TokenProvider()
+        return _default_provider
+
 
 async def main():
+    import zendriver as zd
     browser = await zd.start()
     try:
-        page = await browser.get("https://spotifydown.com/")
+        page = await browser.get(SPOTIFYDOWN_URL)
         token = await wait_for_turnstile_token(page)
         return token
     finally:
@@ -31,5 +180,3 @@ async def main():
 
 if __name__ == "__main__":
     asyncio.run(main())
-
-
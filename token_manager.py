@@ -0,0 +1,237 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class TokenError(RuntimeError):
+    pass
+
+
+class TokenManager:
+    # hands out the current api token, trusting it for ttl seconds.
+    # a token is only refreshed once it is stale or a /download call rejected it,
+    # and only one caller at a time runs the (slow) browser fetch.
+
+    def __init__(self, token, fetch_token, ttl=300, prefetch=None, prefetch_at=0.8):
+        self.token = token or ''
+        self.fetch_token = fetch_token
+        self.ttl = ttl
+        # called once the token is prefetch_at * ttl old, so the next one is ready in time
+        self.prefetch = prefetch
+        self.prefetch_at = prefetch_at
+        self.prefetch_started = False
+        self.fetched_at = time.monotonic()
+        self.rejected = False
+        self.lock = threading.Lock()
+
+    def is_fresh(self):
+        if len(self.token) < 10 or self.rejected:
+            return False
+        return time.monotonic() - self.fetched_at < self.ttl
+
+    def get(self):
+        with self.lock:
+            if not self.is_fresh():
+                self.refresh()
+            elif self.prefetch and not self.prefetch_started and time.monotonic() - self.fetched_at > self.ttl * self.prefetch_at:
+                self.prefetch_started = True
+                self.prefetch()
+            return self.token
+
+    def refresh(self):
+        token = self.fetch_token()
+        if not token:
+            raise TokenError("could not get a new token")
+        self.token = token
+        self.fetched_at = time.monotonic()
+        self.rejected = False
+        self.prefetch_started = False
+
+    @contextmanager
+    def lease(self):
+        # the same interface as TokenPool, there is just the one token to hand out
+        yield self.get()
+
+    def invalidate(self, token):
+        # callers may hold an older token, only reject the one currently in use
+        with self.lock:
+            if token == self.token:
+                self.rejected = True
+
+
+class PooledToken:
+
+    def __init__(self, token, fetched_at=None):
+        self.token = token
+        # wall clock, so the age still holds when the pool is loaded by the next run
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        # link resolutions made with it, and running right now
+        self.uses = 0
+        self.leased = 0
+        self.rejected = False
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+
+class TokenPool:
+    # several api tokens used side by side. Every link resolution leases the least
+    # busy token and gives it back afterwards, with at most max_leases leases per
+    # token at a time (0 for no cap). Tokens rejected with a 403 or older than ttl
+    # are dropped and replaced in the background, one browser fetch at a time,
+    # while the others keep working. A token is replaced ahead of time once it is
+    # prefetch_at * ttl old. The pool is saved to path, so the next run starts with it.
+
+    def __init__(self, fetch_token, size=4, ttl=300, max_leases=0, path=None, prefetch_at=0.8):
+        self.fetch_token = fetch_token
+        self.size = max(1, size)
+        self.ttl = ttl
+        self.max_leases = max_leases
+        self.path = Path(path) if path is not None else None
+        self.prefetch_at = prefetch_at
+        self.tokens = []
+        self.fetched = 0
+        self.rejections = 0
+        # bumped whenever a background fetch comes back empty, so waiting leases give up
+        self.failures = 0
+        self.refilling = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.load()
+
+    @property
+    def token(self):
+        # the newest usable token, for callers wanting just one
+        with self.lock:
+            usable = [pooled for pooled in self.tokens if self.is_usable(pooled)]
+            return max(usable, key=lambda pooled: pooled.fetched_at).token if usable else ''
+
+    def is_usable(self, pooled):
+        return not pooled.rejected and pooled.age() < self.ttl
+
+    def is_lasting(self, pooled):
+        # usable and not due for replacement yet
+        return not pooled.rejected and pooled.age() < self.ttl * self.prefetch_at
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as fp:
+                saved = json.load(fp)
+        except (OSError, ValueError):
+            return
+        for entry in saved.get("tokens", []):
+            pooled = PooledToken(entry["token"], entry["fetched_at"])
+            pooled.uses = entry.get("uses", 0)
+            if self.is_usable(pooled):
+                self.tokens.append(pooled)
+
+    def save(self):
+        # called with the lock held
+        if self.path is None:
+            return
+        data = {"tokens": [{"token": pooled.token, "fetched_at": pooled.fetched_at, "uses": pooled.uses}
+            for pooled in self.tokens if self.is_usable(pooled)]}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            part = self.path.with_name(self.path.name + ".part")
+            part.write_text(json.dumps(data))
+            os.replace(part, self.path)
+        except OSError:
+            pass
+
+    def prune(self):
+        # drops rejected and expired tokens nobody is using anymore
+        kept = [pooled for pooled in self.tokens if self.is_usable(pooled) or pooled.leased]
+        if len(kept) != len(self.tokens):
+            self.tokens = kept
+            self.save()
+
+    def pick(self):
+        available = [pooled for pooled in self.tokens
+            if self.is_usable(pooled) and (not self.max_leases or pooled.leased < self.max_leases)]
+        if not available:
+            return None
+        return min(available, key=lambda pooled: (pooled.leased, pooled.uses))
+
+    def start_refill(self):
+        if self.refilling or self.closed:
+            return
+        if sum(self.is_lasting(pooled) for pooled in self.tokens) >= self.size:
+            return
+        self.refilling = True
+        threading.Thread(target=self.refill, name="token-pool", daemon=True).start()
+
+    def refill(self):
+        while True:
+            with self.lock:
+                if self.closed or sum(self.is_lasting(pooled) for pooled in self.tokens) >= self.size:
+                    self.refilling = False
+                    return
+            token = self.fetch_token()
+            with self.lock:
+                if not token:
+                    self.failures += 1
+                    self.refilling = False
+                    self.changed.notify_all()
+                    return
+                self.fetched += 1
+                self.tokens.append(PooledToken(token))
+                self.prune()
+                self.save()
+                self.changed.notify_all()
+
+    @contextmanager
+    def lease(self):
+        with self.lock:
+            failures = self.failures
+            while True:
+                self.prune()
+                self.start_refill()
+                pooled = self.pick()
+                if pooled is not None:
+                    break
+                if self.failures != failures and not any(self.is_usable(pooled) for pooled in self.tokens):
+                    raise TokenError("could not get a new token")
+                # woken by a fetched token or a returned lease
+                self.changed.wait(timeout=1)
+            pooled.leased += 1
+            pooled.uses += 1
+        try:
+            yield pooled.token
+        finally:
+            with self.lock:
+                pooled.leased -= 1
+                self.changed.notify_all()
+
+    def get(self):
+        # a token without leasing it
+        with self.lease() as token:
+            return token
+
+    def invalidate(self, token):
+        with self.lock:
+            for pooled in self.tokens:
+                if pooled.token == token and not pooled.rejected:
+                    pooled.rejected = True
+                    self.rejections += 1
+            self.prune()
+            self.start_refill()
+
+    def describe(self):
+        with self.lock:
+            usable = [pooled for pooled in self.tokens if self.is_usable(pooled)]
+            uses = ", ".join(str(pooled.uses) for pooled in usable)
+            return (f"{len(usable)} of {self.size} tokens usable (uses: {uses or 'none'}), "
+                f"{self.fetched} fetched, {self.rejections} rejected")
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.save()
+            self.changed.notify_all()
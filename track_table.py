@@ -0,0 +1,75 @@
+import time
+
+from PyQt6.QtCore import Qt, QAbstractTableModel, QModelIndex
+
+
+def format_size(size):
+    if not size:
+        return ""
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f} KB"
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+class TrackTableModel(QAbstractTableModel):
+    # one row per SpotifySong. The rows hold the scraper's track objects and
+    # read them when painted, so an update only has to say which rows changed.
+
+    COLUMNS = ["#", "Track", "Status", "Size", "Time"]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.tracks = []
+        self.rows = {}
+
+    def clear(self):
+        self.beginResetModel()
+        self.tracks = []
+        self.rows = {}
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.tracks)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole or not index.isValid():
+            return None
+        track = self.tracks[index.row()]
+        column = index.column()
+        if column == 0:
+            return index.row() + 1
+        if column == 1:
+            return track.name
+        if column == 2:
+            return track.phase
+        if column == 3:
+            return format_size(track.bytes_downloaded)
+        if column == 4:
+            if track.started_at is None:
+                return ""
+            end = track.finished_at if track.finished_at is not None else time.monotonic()
+            return f"{end - track.started_at:.1f}s"
+        return None
+
+    def update_tracks(self, tracks):
+        # applies one batch of updates: new tracks are appended in one insert,
+        # changed rows are repainted with a single dataChanged over their range
+        new_tracks = [track for track in tracks if id(track) not in self.rows]
+        if new_tracks:
+            first = len(self.tracks)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_tracks) - 1)
+            for track in new_tracks:
+                self.rows[id(track)] = len(self.tracks)
+                self.tracks.append(track)
+            self.endInsertRows()
+        changed = [self.rows[id(track)] for track in tracks]
+        if changed:
+            self.dataChanged.emit(self.index(min(changed), 0), self.index(max(changed), len(self.COLUMNS) - 1))
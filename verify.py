@@ -0,0 +1,260 @@
+import mmap
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from id3_tags import ID3_HEADER_SIZE, id3v2_size
+from library_store import LIBRARY_DIRNAME, LibraryStore
+from sync_state import SyncState, SYNC_STATE_FILENAME, DONE, FAILED
+from watchlist import WatchlistState, WATCHLIST_STATE_FILENAME
+
+# Checks the mp3 files of an output tree without decoding them: each file is
+# memory mapped and only the id3 header, the first mpeg frame (and its Xing/Info
+# header) and the frames at the very end are looked at. Only files a folder's
+# sync state records as downloaded are checked, other music is left alone.
+
+# kbps by bitrate index, for mpeg 1 and mpeg 2/2.5 layer III
+BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0),
+}
+# by the version bits of the frame header, 1 is reserved
+SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+# largest layer III frame: 320 kbps at 32 kHz, padded
+MAX_FRAME_SIZE = 1441
+ID3V1_SIZE = 128
+APE_FOOTER_SIZE = 32
+# "LYRICS200" preceded by the six digit size of the lyrics3 v2 tag
+LYRICS3_FOOTER_SIZE = 15
+# bytes after the id3 tag searched for the first frame
+SYNC_SEARCH = 4096
+CORRUPT_SUFFIX = ".corrupt"
+
+
+def frame_header(data, pos):
+    # (frame length, samples in the frame, sample rate) of the layer III frame at pos, None if there is none
+    if pos + 4 > len(data):
+        return None
+    b0, b1, b2 = data[pos], data[pos + 1], data[pos + 2]
+    if b0 != 0xff or b1 & 0xe0 != 0xe0:
+        return None
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 1
+    if version == 3:
+        return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+    return 72 * bitrate // sample_rate + padding, 576, sample_rate
+
+
+def xing_header(data, pos):
+    # (frame count, byte count) from the Xing/Info header of the frame at pos, either can be None
+    version = (data[pos + 1] >> 3) & 3
+    mono = data[pos + 3] >> 6 == 3
+    if version == 3:
+        offset = pos + 4 + (17 if mono else 32)
+    else:
+        offset = pos + 4 + (9 if mono else 17)
+    if data[offset:offset + 4] not in (b"Xing", b"Info"):
+        return None, None
+    flags = int.from_bytes(data[offset + 4:offset + 8], "big")
+    offset += 8
+    frames = byte_count = None
+    if flags & 1:
+        frames = int.from_bytes(data[offset:offset + 4], "big")
+        offset += 4
+    if flags & 2:
+        byte_count = int.from_bytes(data[offset:offset + 4], "big")
+    return frames, byte_count
+
+
+def find_frame(data, start, stop):
+    # first position in [start, stop) with a frame followed by another one
+    pos = data.find(b"\xff", start, stop)
+    while pos != -1:
+        header = frame_header(data, pos)
+        if header is not None and (pos + header[0] >= len(data) or frame_header(data, pos + header[0]) is not None):
+            return pos
+        pos = data.find(b"\xff", pos + 1, stop)
+    return None
+
+
+def ends_with_frame(data, start, end):
+    # whether a complete frame ends exactly at end, a cut download stops in the middle of one
+    pos = data.find(b"\xff", max(start, end - 2 * MAX_FRAME_SIZE), end)
+    while pos != -1:
+        header = frame_header(data, pos)
+        if header is not None and pos + header[0] == end:
+            return True
+        pos = data.find(b"\xff", pos + 1, end)
+    return False
+
+
+def audio_end(data, start, end):
+    # end of the audio, before any id3v1, apev2 and lyrics3 v2 tags other tools append
+    while True:
+        if end - start > ID3V1_SIZE and data[end - ID3V1_SIZE:end - ID3V1_SIZE + 3] == b"TAG":
+            end -= ID3V1_SIZE
+        elif end - start > APE_FOOTER_SIZE and data[end - APE_FOOTER_SIZE:end - APE_FOOTER_SIZE + 8] == b"APETAGEX":
+            footer = end - APE_FOOTER_SIZE
+            # the size counts the items and the footer, the header comes on top
+            tag_size = int.from_bytes(data[footer + 12:footer + 16], "little")
+            has_header = int.from_bytes(data[footer + 20:footer + 24], "little") & 0x80000000
+            tag_start = end - tag_size - (APE_FOOTER_SIZE if has_header else 0)
+            if tag_start < start:
+                return end
+            end = tag_start
+        elif end - start > LYRICS3_FOOTER_SIZE and data[end - 9:end] == b"LYRICS200" and data[end - 15:end - 9].isdigit():
+            tag_start = end - LYRICS3_FOOTER_SIZE - int(data[end - 15:end - 9])
+            if tag_start < start or data[tag_start:tag_start + 11] != b"LYRICSBEGIN":
+                return end
+            end = tag_start
+        else:
+            return end
+
+
+def check_mp3(data):
+    # (what is wrong with the mp3 in data or None if it looks whole, a warning or None)
+    size = len(data)
+    warning = None
+    if data[:3] == b"ID3":
+        start = id3v2_size(data[:ID3_HEADER_SIZE])
+        if start >= size:
+            return "cut off in the id3 tag", None
+    else:
+        # not written by the downloader, or the tag was stripped, the audio can still be whole
+        warning = "no id3 tag"
+        start = 0
+    end = audio_end(data, start, size)
+    first = find_frame(data, start, min(end, start + SYNC_SEARCH))
+    if first is None:
+        return "no mpeg audio after the id3 tag", warning
+    frames, byte_count = xing_header(data, first)
+    if byte_count is not None and end - first < byte_count:
+        frame_size, samples, sample_rate = frame_header(data, first)
+        missing = ""
+        if frames:
+            # how much of the expected duration is there, assuming constant frame sizes
+            duration = frames * samples / sample_rate
+            missing = f", {duration * (end - first) / byte_count:.0f} of {duration:.0f} seconds"
+        return f"cut off, {end - first} of {byte_count} audio bytes{missing}", warning
+    if not ends_with_frame(data, first, end):
+        return "cut off or corrupt at the end", warning
+    return None, warning
+
+
+def check_file(path):
+    # (path, problem or None, warning or None)
+    try:
+        if os.path.getsize(path) == 0:
+            return path, "empty file", None
+        with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return (path, *check_mp3(data))
+    except (OSError, ValueError) as exc:
+        return path, f"unreadable: {str(exc)}", None
+
+
+def synced_files(root):
+    # (mp3 files recorded as downloaded by a sync state, number of other mp3 files left alone)
+    paths = []
+    unmanaged = 0
+    for folder, folders, files in os.walk(root):
+        folders[:] = [name for name in folders if name != LIBRARY_DIRNAME]
+        done = set()
+        if SYNC_STATE_FILENAME in files:
+            sync_state = SyncState(Path(folder))
+            try:
+                done = {record.filename for record in sync_state.all() if record.status == DONE}
+            finally:
+                sync_state.close()
+        for name in files:
+            if not name.lower().endswith(".mp3") or name.startswith("."):
+                continue
+            if name in done:
+                paths.append(os.path.join(folder, name))
+            else:
+                unmanaged += 1
+    return paths, unmanaged
+
+
+def verify_tree(root, processes=None, chunksize=64):
+    # (number of files checked, {path: problem} for the bad ones, {path: warning},
+    # number of mp3 files no sync state lists), checked in parallel processes
+    paths, unmanaged = synced_files(root)
+    checked = 0
+    bad = {}
+    warnings = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for path, problem, warning in executor.map(check_file, paths, chunksize=chunksize):
+            checked += 1
+            if problem is not None:
+                bad[path] = problem
+            if warning is not None:
+                warnings[path] = warning
+    return checked, bad, warnings, unmanaged
+
+
+def requeue(root, paths):
+    # moves bad files aside and marks them failed in their folder's sync state,
+    # so the next sync downloads them again instead of linking them from the library.
+    # returns the paths moved, files no sync state records as downloaded are never touched.
+    library = LibraryStore(root) if os.path.isdir(Path(root) / LIBRARY_DIRNAME) else None
+    by_folder = defaultdict(set)
+    for path in paths:
+        path = Path(path)
+        by_folder[path.parent].add(path.name)
+    moved = []
+    try:
+        for folder, filenames in by_folder.items():
+            if not (folder / SYNC_STATE_FILENAME).exists():
+                continue
+            sync_state = SyncState(folder)
+            try:
+                for record in sync_state.all():
+                    if record.filename not in filenames or record.status != DONE:
+                        continue
+                    path = folder / record.filename
+                    os.replace(path, path.with_name(f".{path.name}{CORRUPT_SUFFIX}"))
+                    moved.append(path)
+                    sync_state.set(record.id, record.filename, FAILED)
+                    if library is not None:
+                        library.remove(record.id)
+            finally:
+                sync_state.close()
+    finally:
+        if library is not None:
+            library.close()
+    # a watchlist would skip the unchanged playlists holding them
+    if moved and os.path.exists(Path(root) / WATCHLIST_STATE_FILENAME):
+        watchlist_state = WatchlistState(Path(root) / WATCHLIST_STATE_FILENAME)
+        watchlist_state.clear()
+        watchlist_state.close()
+    return moved
+
+
+def main(root, processes=None, move_aside=False, log=print):
+    # returns the number of bad files
+    start = time.perf_counter()
+    checked, bad, warnings, unmanaged = verify_tree(root, processes)
+    for path, warning in sorted(warnings.items()):
+        log(f"{os.path.relpath(path, root)}: warning: {warning}")
+    for path, problem in sorted(bad.items()):
+        log(f"{os.path.relpath(path, root)}: {problem}")
+    if bad and move_aside:
+        moved = requeue(root, bad)
+        log(f"moved {len(moved)} files aside, the next sync downloads them again")
+    log(f"verified {checked} files in {root} in {time.perf_counter() - start:.1f}s, {len(bad)} bad")
+    if unmanaged:
+        log(f"left {unmanaged} mp3 files alone that no sync recorded as downloaded")
+    return len(bad)
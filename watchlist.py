@@ -0,0 +1,173 @@
+import heapq
+import itertools
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from library_store import InflightDownloads
+
+WATCHLIST_STATE_FILENAME = ".spotifydownloader-watchlist.sqlite3"
+
+DAY = 24 * 60 * 60
+
+
+@dataclass
+class WatchlistEntry:
+    url: str
+    # higher first, both when scheduling syncs and when handing out download slots
+    priority: int = 0
+
+
+def load_watchlist(path):
+    # one url per line, optionally followed by a priority. # starts a comment.
+    #   https://open.spotify.com/playlist/{id} 10
+    entries = []
+    with open(path) as fp:
+        for line_number, line in enumerate(fp, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) > 2:
+                raise ValueError(f"{path}:{line_number}: expected a url and an optional priority")
+            try:
+                priority = int(fields[1]) if len(fields) == 2 else 0
+            except ValueError:
+                raise ValueError(f"{path}:{line_number}: priority has to be a number, got {fields[1]}")
+            entries.append(WatchlistEntry(fields[0], priority))
+    return entries
+
+
+class PrioritySlots:
+    # a fixed number of slots shared by all running syncs. When slots are short
+    # they go to the waiter with the highest priority, first come first served within one.
+
+    def __init__(self, size):
+        self.free = max(1, size)
+        self.waiters = []
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    @contextmanager
+    def slot(self, priority=0):
+        with self.lock:
+            ticket = (-priority, next(self.order))
+            heapq.heappush(self.waiters, ticket)
+            while self.free == 0 or self.waiters[0] != ticket:
+                self.changed.wait()
+            heapq.heappop(self.waiters)
+            self.free -= 1
+            # the next waiter may get a slot too
+            self.changed.notify_all()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.free += 1
+                self.changed.notify_all()
+
+
+class WatchlistState:
+    # what the last sync of each url saw, kept next to the synced folders
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                url TEXT PRIMARY KEY,
+                fingerprint TEXT,
+                failed INTEGER NOT NULL,
+                synced_at REAL NOT NULL)""")
+
+    def get(self, url):
+        # (fingerprint, failed track count, synced_at) or None
+        with self.lock:
+            return self.db.execute("SELECT fingerprint, failed, synced_at FROM entries WHERE url = ?", (url,)).fetchone()
+
+    def set(self, url, fingerprint, failed):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO entries (url, fingerprint, failed, synced_at) VALUES (?, ?, ?, ?)",
+                (url, fingerprint, failed, time.time()))
+
+    def clear(self):
+        # the next cycle syncs every url in full
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM entries")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class WatchlistSync:
+    # syncs every url of a watchlist, max_syncs at a time, highest priority and
+    # longest unsynced first. All syncs share download_budget download slots and,
+    # per cycle, the set of tracks being downloaded so a track is fetched once.
+    # A playlist or album whose /metadata and /trackList pages did not change
+    # since its last clean sync is skipped, up to full_sync_every seconds.
+
+    def __init__(self, entries, state, make_scraper, max_syncs=2, download_budget=4, full_sync_every=DAY, log=print):
+        self.entries = entries
+        self.state = state
+        # make_scraper(url, **kwargs) returns a SpotifyScraper for url with the given extra arguments
+        self.make_scraper = make_scraper
+        self.max_syncs = max(1, max_syncs)
+        self.download_budget = download_budget
+        self.full_sync_every = full_sync_every
+        self.log = log
+        self.stopped = threading.Event()
+
+    def schedule(self):
+        def last_synced(entry):
+            record = self.state.get(entry.url)
+            return record[2] if record else 0
+        return sorted(self.entries, key=lambda entry: (-entry.priority, last_synced(entry)))
+
+    def run_cycle(self):
+        # returns the number of failed tracks over all urls
+        slots = PrioritySlots(self.download_budget)
+        inflight = InflightDownloads()
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_syncs) as executor:
+            futures = [executor.submit(self.sync, entry, slots, inflight) for entry in self.schedule()]
+            results = [future.result() for future in futures]
+        synced = sum(result is not None for result in results)
+        failed = sum(result or 0 for result in results)
+        self.log(f"sync cycle done in {time.monotonic() - start:.0f}s: {synced} synced, "
+            f"{len(results) - synced} unchanged, {failed} failed tracks")
+        return failed
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_unchanged(self, entry, fingerprint):
+        record = self.state.get(entry.url)
+        if record is None or fingerprint is None:
+            return False
+        last_fingerprint, failed, synced_at = record
+        return last_fingerprint == fingerprint and failed == 0 and time.time() - synced_at < self.full_sync_every
+
+    def sync(self, entry, slots, inflight):
+        # failed track count, None if the url was skipped
+        if self.stopped.is_set():
+            return None
+        scraper = self.make_scraper(entry.url, download_slots=slots, priority=entry.priority, inflight=inflight)
+        try:
+            fingerprint = scraper.metadata_fingerprint()
+        except Exception as exc:
+            self.log(f"{entry.url}: metadata check failed, syncing anyway: {str(exc)}")
+            fingerprint = None
+        if self.is_unchanged(entry, fingerprint):
+            self.log(f"{entry.url}: unchanged, skipping")
+            return None
+        scraper.run()
+        failed = scraper.failed_track_count()
+        if scraper.run_error is not None:
+            # counts as a failure, so the next cycle does not skip it
+            failed += 1
+        self.state.set(entry.url, fingerprint, failed)
+        return failed